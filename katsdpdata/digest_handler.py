@@ -0,0 +1,217 @@
+import concurrent.futures as futures
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import time
+
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+DIGEST_ALGORITHM = 'md5'
+DIGEST_BLOCK_SIZE = 16 * 2**20
+PROGRESS_INTERVAL = 30
+DIGEST_CACHE_PATH = os.environ.get('KATSDPDATA_DIGEST_CACHE',
+                                   os.path.expanduser('~/.cache/katsdpdata/digests.sqlite'))
+XATTR_PREFIX = 'user.katsdpdata.digest.'
+
+
+class DigestHandlerException(Exception):
+    """Handle exceptions generated by the digest handler."""
+    pass
+
+
+def file_digest(filename, algorithm=DIGEST_ALGORITHM, block_size=DIGEST_BLOCK_SIZE, use_mmap=False):
+    """Calculate the digest of a file in-process. The file is read in large
+    blocks, with the next block read on a separate thread while the current
+    one is hashed. hashlib releases the GIL while hashing, so reading and
+    hashing overlap, and several files can be hashed in parallel with threads.
+
+    Parameters
+    ----------
+    filename: string : full path to the file.
+    algorithm: string : any algorithm supported by hashlib.new. E.g. 'md5' or 'sha256'
+    block_size: int : size in bytes of each read. Rounded to a multiple of the page size.
+    use_mmap: boolean : hash from a memory map of the file, rather than reading into buffers.
+
+    Returns
+    -------
+    digest: string : the hex digest of the file.
+    """
+    try:
+        digest = hashlib.new(algorithm)
+    except ValueError:
+        raise DigestHandlerException('{} is not a supported digest algorithm.'.format(algorithm))
+    # keep reads page aligned
+    block_size = max(mmap.PAGESIZE, block_size - block_size % mmap.PAGESIZE)
+    file_size = os.path.getsize(filename)
+    start_time = time.time()
+    if use_mmap and file_size > 0:
+        _mmap_digest(filename, digest, block_size, file_size, start_time)
+    else:
+        _read_digest(filename, digest, block_size, file_size, start_time)
+    elapsed = time.time() - start_time
+    logger.info('%s digest of %s complete in %.1f s (%.1f MB/s).', algorithm, filename,
+                elapsed, file_size / 1e6 / max(elapsed, 1e-6))
+    return digest.hexdigest()
+
+
+class DigestCache(object):
+    """Persistent cache of file digests, so that retried or repeated extractions
+    don't hash the same file again. Entries are keyed on the file identity
+    (device, inode, size, mtime_ns), so a file that has changed is hashed again.
+
+    Digests are stored in an extended attribute on the file where the file
+    system allows it, and otherwise in a local sqlite store.
+
+    Parameters
+    ----------
+    path: string : path to the sqlite store.
+    use_xattr: boolean : try to store digests in extended attributes first.
+    """
+    def __init__(self, path=DIGEST_CACHE_PATH, use_xattr=True):
+        super(DigestCache, self).__init__()
+        self.path = path
+        self.use_xattr = use_xattr and hasattr(os, 'setxattr')
+        self._db_ready = False
+
+    def get(self, filename, algorithm=DIGEST_ALGORITHM):
+        """Get the cached digest of a file.
+
+        Parameters
+        ----------
+        filename: string : full path to the file.
+        algorithm: string : the digest algorithm.
+
+        Returns
+        -------
+        digest: string : the hex digest, None if not cached or the file has changed.
+        """
+        st = os.stat(filename)
+        if self.use_xattr:
+            try:
+                value = os.getxattr(filename, XATTR_PREFIX + algorithm).decode()
+                size, mtime_ns, digest = value.split(':')
+                if int(size) == st.st_size and int(mtime_ns) == st.st_mtime_ns:
+                    return digest
+            except OSError:
+                pass
+            except ValueError:
+                # a malformed or truncated value is a miss, it is replaced by put
+                logger.debug('Ignoring malformed digest attribute on %s.', filename)
+        try:
+            with closing(self._connect()) as conn:
+                row = conn.execute('SELECT digest FROM digests WHERE dev=? AND ino=? AND size=? AND mtime_ns=? '
+                                   'AND algorithm=?',
+                                   (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm)).fetchone()
+        except (OSError, sqlite3.Error) as err:
+            logger.warning('Digest cache %s not available: %s', self.path, err)
+            return None
+        return row[0] if row else None
+
+    def put(self, filename, algorithm, digest):
+        """Store the digest of a file.
+
+        Parameters
+        ----------
+        filename: string : full path to the file.
+        algorithm: string : the digest algorithm.
+        digest: string : the hex digest.
+        """
+        st = os.stat(filename)
+        if self.use_xattr:
+            value = '{}:{}:{}'.format(st.st_size, st.st_mtime_ns, digest)
+            try:
+                os.setxattr(filename, XATTR_PREFIX + algorithm, value.encode())
+                return
+            except OSError as err:
+                # fall back to the sqlite store, a failure to cache mustn't stop the caller
+                if err.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES, errno.EROFS):
+                    logger.warning('Digest for %s not stored in an extended attribute: %s', filename, err)
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                             (st.st_dev, st.st_ino, algorithm, st.st_size, st.st_mtime_ns, digest))
+        except (OSError, sqlite3.Error) as err:
+            logger.warning('Digest for %s not cached in %s: %s', filename, self.path, err)
+
+    def digest(self, filename, algorithm=DIGEST_ALGORITHM, **kwargs):
+        """Return the digest of a file from the cache, hashing and caching it if needed.
+
+        Parameters
+        ----------
+        filename: string : full path to the file.
+        algorithm: string : any algorithm supported by hashlib.new.
+        kwargs: dict : further keyword arguments for file_digest.
+
+        Returns
+        -------
+        digest: string : the hex digest of the file.
+        """
+        digest = self.get(filename, algorithm)
+        if digest:
+            logger.debug('Using cached %s digest for %s.', algorithm, filename)
+            return digest
+        digest = file_digest(filename, algorithm, **kwargs)
+        self.put(filename, algorithm, digest)
+        return digest
+
+    def _connect(self):
+        if not self._db_ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # a connection per call keeps the cache safe to use from several threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._db_ready:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS digests (dev INTEGER, ino INTEGER, algorithm TEXT, '
+                             'size INTEGER, mtime_ns INTEGER, digest TEXT, PRIMARY KEY (dev, ino, algorithm))')
+            self._db_ready = True
+        return conn
+
+
+def _log_progress(filename, done, file_size, start_time, last_log):
+    now = time.time()
+    if now - last_log < PROGRESS_INTERVAL:
+        return last_log
+    elapsed = now - start_time
+    logger.debug('Hashed %.0f of %.0f MB of %s (%.1f MB/s).', done / 1e6, file_size / 1e6,
+                 filename, done / 1e6 / max(elapsed, 1e-6))
+    return now
+
+
+def _read_digest(filename, digest, block_size, file_size, start_time):
+    buffers = [bytearray(block_size), bytearray(block_size)]
+    done = 0
+    last_log = start_time
+    with open(filename, 'rb', buffering=0) as f:
+        with futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='digest-read') as reader:
+            current = 0
+            pending = reader.submit(f.readinto, buffers[current])
+            while True:
+                nbytes = pending.result()
+                if not nbytes:
+                    break
+                # read the next block while this one is hashed
+                pending = reader.submit(f.readinto, buffers[1 - current])
+                digest.update(memoryview(buffers[current])[:nbytes])
+                current = 1 - current
+                done += nbytes
+                last_log = _log_progress(filename, done, file_size, start_time, last_log)
+
+
+def _mmap_digest(filename, digest, block_size, file_size, start_time):
+    last_log = start_time
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+            try:
+                for offset in range(0, file_size, block_size):
+                    digest.update(view[offset:offset + block_size])
+                    last_log = _log_progress(filename, offset + block_size, file_size, start_time, last_log)
+            finally:
+                view.release()
@@ -1,6 +1,6 @@
 import os
-import katsdptelstate
 from .met_extractors import MeerKATTelescopeProductMetExtractor, MeerKATFlagProductMetExtractor
+from .rdb_handler import read_capture_stream_attrs
 
 
 class ProductTypeDetectionError(Exception):
@@ -16,7 +16,7 @@ def file_type_detection(filename):
 
     Returns
     -------
-    MetExtractor: class : A metadata extractor class to extract metadata from the product
+    MetExtractor: object : A metadata extractor bound to the loaded product
     """
     ext = os.path.splitext(filename)[1]
     if ext == '.rdb':
@@ -35,14 +35,15 @@ def telstate_detection(filename):
 
     Returns
     -------
-    MetExtractor: class : A metadata extractor class to extract metadata from the rdb file.
+    MetExtractor: object : A metadata extractor for the rdb file. Detection only
+    reads the keys it needs, so the file is only parsed in full once.
     """
-    ts = katsdptelstate.TelescopeState()
-    ts.load_from_file(filename)
-    stream_name = ts['stream_name']
-    v = ts.view(stream_name)
-    if v['stream_type'] == 'sdp.vis':
-        return MeerKATTelescopeProductMetExtractor
-    elif v['stream_type'] == 'sdp.flags':
-        return MeerKATFlagProductMetExtractor
+    # only the few keys needed are read, rather than loading every sensor
+    attrs = read_capture_stream_attrs(filename)
+    if 'stream_name' not in attrs or 'stream_type' not in attrs:
+        raise ProductTypeDetectionError('%s is not a capture stream rdb file.' % (filename,))
+    if attrs['stream_type'] == 'sdp.vis':
+        return MeerKATTelescopeProductMetExtractor(filename)
+    elif attrs['stream_type'] == 'sdp.flags':
+        return MeerKATFlagProductMetExtractor(filename, attrs)
     raise ProductTypeDetectionError('%s not a recognisable stream type')
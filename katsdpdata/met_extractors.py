@@ -1,23 +1,82 @@
+import collections
+import functools
+import io
+import json
 import katdal
 import katpoint
-import katsdptelstate
 import logging
 import numpy as np
 import os
-import subprocess
 import time
 
-from xml.etree import ElementTree
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
 from math import floor
 
+from .digest_handler import DIGEST_ALGORITHM, DigestCache, file_digest
+from .rdb_handler import read_rdb_keys
+
 logger = logging.getLogger(__name__)
 
+CAS_XMLNS = 'http://oodt.jpl.nasa.gov/1.0/cas'
+
+# katdata fields timed separately from the other katdata fields
+KATDATA_FIELD_STAGES = {'Details': 'katdal_summary', 'Targets': 'targets', 'KatpointTargets': 'targets'}
+
+# fields that extract_metadata can be asked for, besides those in katdata_fields
+EXTRACTOR_FIELDS = ('CaptureBlockId', 'CaptureStreamId', 'DecRa', 'ElAz', 'FileDigest', 'Instrument', 'IssueId',
+                    'Prefix', 'ProgramBlockId', 'ProposalDescription', 'ProposalId', 'ReductionLabel',
+                    'ReductionName', 'ScheduleBlockIdCode', 'StreamId', 'SubarrayNumber', 'SubarrayProduct',
+                    'SubarrayProductId')
+
 
 class MetExtractorException(Exception):
     """Raises a MetExtractor exception."""
     pass
 
 
+def _timed_stage(stage):
+    """Decorator recording the run time of an extraction step in the extractor's
+    stage_times, under the given stage name."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start_time = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._record_stage(stage, time.time() - start_time)
+        return wrapper
+    return decorator
+
+
+def met_text(value):
+    """Convert a metadata value to text. Bytes, such as digests, are decoded and
+    anything else that isn't a string is formatted with str.
+
+    Parameters
+    ----------
+    value: object : a single metadata value.
+
+    Returns
+    -------
+    text: string : the value as text, None if the value is None.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', 'replace')
+    return str(value)
+
+
+def met_texts(value):
+    """Convert a metadata value to a list of text values. Lists, tuples and
+    arrays give a value per item, anything else a single value."""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [met_text(v) for v in value]
+    return [met_text(value)]
+
+
 class MetExtractor(object):
     """Base class for handling metadata extraction. This class can be used to
     create an empty met file that complies with OODT ingest"
@@ -36,10 +95,15 @@ class MetExtractor(object):
     product_type : string : Specify product type for OODT Filemananger ingest
         set to None
 
+    stage_times : OrderedDict : seconds spent in each extraction stage, e.g. 'open' or 'digest'.
+
+    stage_bytes : dict : bytes processed by each extraction stage, where known.
+
     Hidden Attributes
     -----------------
     _metadata_extracted : boolean : keep track of metadata extraction.
         The access handler to a katfile.
+    _fields : set : fields selected for the current extraction. None for all fields.
     """
 
     def __init__(self, metadata_filename):
@@ -48,41 +112,126 @@ class MetExtractor(object):
         self.metadata = {}
         self.product_type = None
         self._metadata_extracted = False
+        self._fields = None
+        self.stage_times = collections.OrderedDict()
+        self.stage_bytes = {}
+
+    def _record_stage(self, stage, elapsed, nbytes=None):
+        """Add the time taken, and optionally the bytes processed, to an extraction stage."""
+        self.stage_times[stage] = self.stage_times.get(stage, 0.0) + elapsed
+        if nbytes is not None:
+            self.stage_bytes[stage] = self.stage_bytes.get(stage, 0) + nbytes
+
+    def stage_summary(self):
+        """Summarise the time and bytes of each extraction stage for logging.
+
+        Returns
+        -------
+        summary: string : E.g. 'open 2.10 s (120.5 MB), katdata 0.31 s, digest 8.02 s (2048.0 MB)'
+        """
+        stages = []
+        for stage, elapsed in self.stage_times.items():
+            if stage in self.stage_bytes:
+                stages.append('%s %.2f s (%.1f MB)' % (stage, elapsed, self.stage_bytes[stage] / 1e6))
+            else:
+                stages.append('%s %.2f s' % (stage, elapsed))
+        return ', '.join(stages)
+
+    @contextmanager
+    def _extracting(self, fields):
+        """Select the fields for one run of extract_metadata. Only a run for all
+        fields marks the metadata as extracted, so a field-limited run is never
+        mistaken for a complete extraction."""
+        self._fields = None if fields is None else set(fields)
+        try:
+            yield
+        finally:
+            self._fields = None
+        if fields is None:
+            self._metadata_extracted = True
+
+    def _wants(self, *names):
+        """True if any of the named fields should be extracted. Every field is
+        extracted, unless extract_metadata was asked for specific fields."""
+        return self._fields is None or not self._fields.isdisjoint(names)
 
     def _extract_metadata_product_type(self):
         self.metadata['ProductType'] = self.product_type
         self.metadata['CAS.ProductTypeName'] = self.product_type
 
     def __str__(self):
-        xml_tree = ElementTree.Element('cas:metadata')
-        xml_tree.set('xmlns:cas', 'http://oodt.jpl.nasa.gov/1.0/cas')
-        for k in self.metadata.keys():
-            keyval = ElementTree.SubElement(xml_tree, 'keyval')
-            keyval.tail = '\n'
-            key = ElementTree.SubElement(keyval, 'key')
-            key.text = str(k)
-            key.tail = '\n'
-            if isinstance(self.metadata[k], list):
-                for text in self.metadata[k]:
-                    val = ElementTree.SubElement(keyval, 'val')
-                    val.text = text
-                    val.tail = '\n'
-            else:
-                val = ElementTree.SubElement(keyval, 'val')
-                val.text = self.metadata[k]
-                val.tail = '\n'
-        to_string = ElementTree.tostring(xml_tree, method='xml')
-        return to_string.decode('utf8')
+        metfile = io.StringIO()
+        self.write_xml(metfile)
+        return metfile.getvalue()
+
+    def write_xml(self, metfile):
+        """Write the metadata as an OODT cas:metadata document, escaping and
+        writing each value straight to the file rather than building a tree.
 
-    def extract_metadata(self):
+        Parameters
+        ----------
+        metfile: file : text file handle to write to.
+        """
+        metfile.write('<cas:metadata xmlns:cas="{}">'.format(CAS_XMLNS))
+        for k, v in self.metadata.items():
+            metfile.write('<keyval><key>{}</key>\n'.format(escape(str(k))))
+            for text in met_texts(v):
+                # like ElementTree, write an empty value as a short empty element
+                if not text:
+                    metfile.write('<val />\n')
+                else:
+                    metfile.write('<val>{}</val>\n'.format(escape(text)))
+            metfile.write('</keyval>\n')
+        metfile.write('</cas:metadata>')
+
+    def solr_doc(self):
+        """Return the metadata as a solr document, with every value converted to
+        text, or a list of text for multi-valued fields. None values are left out.
+
+        Returns
+        -------
+        doc: dict : the solr document.
+        """
+        doc = {}
+        for k, v in self.metadata.items():
+            if isinstance(v, (list, tuple, np.ndarray)):
+                doc[k] = met_texts(v)
+            elif v is not None:
+                doc[k] = met_text(v)
+        return doc
+
+    def write_json(self, metfile):
+        """Write the metadata as a json solr document.
+
+        Parameters
+        ----------
+        metfile: file : text file handle to write to.
+        """
+        json.dump(self.solr_doc(), metfile, indent=1, sort_keys=True)
+        metfile.write('\n')
+
+    def extract_metadata(self, fields=None):
         raise NotImplementedError
 
-    def write_metadatafile(self):
-        if self._metadata_extracted:
-            with open(self.metadata_filename, 'w') as metfile:
-                metfile.write(str(self))
-        else:
+    def write_metadatafile(self, fmt='xml'):
+        """Write the metadata file.
+
+        Parameters
+        ----------
+        fmt: string : 'xml' for an OODT .met file, or 'json' for a solr document
+            written next to it with a .json extension.
+        """
+        if not self._metadata_extracted:
             raise MetExtractorException('No metadata extracted.')
+        if fmt == 'xml':
+            # like ElementTree, write non-ascii characters as character references
+            with open(self.metadata_filename, 'w', encoding='ascii', errors='xmlcharrefreplace') as metfile:
+                self.write_xml(metfile)
+        elif fmt == 'json':
+            with open(os.path.splitext(self.metadata_filename)[0] + '.json', 'w') as metfile:
+                self.write_json(metfile)
+        else:
+            raise MetExtractorException('Unknown metadata file format %s.' % (fmt,))
 
 
 class TelescopeProductMetExtractor(MetExtractor):
@@ -97,35 +246,47 @@ class TelescopeProductMetExtractor(MetExtractor):
         self._katdata = katdata
         super(TelescopeProductMetExtractor, self).__init__(metfilename)
 
-    def _extract_metadata_from_katdata(self):
-        """Populate self.metadata: Get information using katdal"""
-        self.metadata['Antennas'] = [a.name for a in self._katdata.ants]
-        center_freq = self._katdata.channel_freqs[floor(self._katdata.channels[-1]/2)]
-        self.metadata['CenterFrequency'] = "{:.2f}".format(center_freq)
-        self.metadata['ChannelWidth'] = str(self._katdata.channel_width)
-        self.metadata['MinFreq'] = str(min(self._katdata.freqs))
-        self.metadata['MaxFreq'] = str(max(self._katdata.freqs) + self._katdata.channel_width)
-        self.metadata['Bandwidth'] = str(max(self._katdata.freqs) - min(self._katdata.freqs) +
-                                         self._katdata.channel_width)
-        self.metadata['Description'] = self._katdata.description
-        self.metadata['Details'] = str(self._katdata)
-        self.metadata['DumpPeriod'] = '%.4f' % (self._katdata.dump_period)
-        self.metadata['Duration'] = str(round(self._katdata.end_time-self._katdata.start_time, 2))
-        self.metadata['ExperimentID'] = self._katdata.experiment_id
-        if self._katdata.file:
-            self.metadata['FileSize'] = str(os.path.getsize(self._katdata.file.filename))
-        else:
-            self.metadata['FileSize'] = str(self._katdata.size)
-        self.metadata['KatfileVersion'] = self._katdata.version
+    def katdata_fields(self):
+        """Registry of the metadata fields read from katdal, in extraction order.
+
+        Returns
+        -------
+        fields: OrderedDict : field name mapped to a getter for its value. A getter
+            returning None leaves the field out. Getters are only called for the
+            fields being extracted, so expensive ones like Details cost nothing
+            when they are not asked for.
+        """
+        d = self._katdata
+        return collections.OrderedDict([
+            ('Antennas', lambda: [a.name for a in d.ants]),
+            ('CenterFrequency', lambda: "{:.2f}".format(d.channel_freqs[floor(d.channels[-1]/2)])),
+            ('ChannelWidth', lambda: str(d.channel_width)),
+            ('MinFreq', lambda: str(min(d.freqs))),
+            ('MaxFreq', lambda: str(max(d.freqs) + d.channel_width)),
+            ('Bandwidth', lambda: str(max(d.freqs) - min(d.freqs) + d.channel_width)),
+            ('Description', lambda: d.description),
+            # katdal builds its full summary of the data set for this
+            ('Details', lambda: str(d)),
+            ('DumpPeriod', lambda: '%.4f' % (d.dump_period)),
+            ('Duration', lambda: str(round(d.end_time-d.start_time, 2))),
+            ('ExperimentID', lambda: d.experiment_id),
+            ('FileSize', lambda: str(os.path.getsize(d.file.filename)) if d.file else str(d.size)),
+            ('KatfileVersion', lambda: d.version),
+            ('KatpointTargets', self._katpoint_targets),
+            ('NumFreqChannels', lambda: str(len(d.channels))),
+            ('Observer', lambda: d.observer),
+            ('RefAntenna', lambda: d.ref_ant),
+            ('StartTime', lambda: time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(floor(d.start_time.secs)))),
+            ('Targets', self._target_names),
+            ('InstructionSet', self._instruction_set),
+        ])
+
+    def _katpoint_targets(self):
         # katpoint target strings could be used directly to create a katpoint target from the string
         # so radec/azel are valid katpoint targets (unlike Targets)
-        self.metadata['KatpointTargets'] = [t.description for t in self._katdata.catalogue.targets
-                                            if t.name not in ['None', 'Nothing']]
-        self.metadata['NumFreqChannels'] = str(len(self._katdata.channels))
-        self.metadata['Observer'] = self._katdata.observer
-        self.metadata['RefAntenna'] = self._katdata.ref_ant
-        int_secs = floor(self._katdata.start_time.secs)
-        self.metadata['StartTime'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(int_secs))
+        return [t.description for t in self._katdata.catalogue.targets if t.name not in ['None', 'Nothing']]
+
+    def _target_names(self):
         # targets are for archive string searches and radec/azel polute string searches
         target_names = []
         for t in self._katdata.catalogue.targets:
@@ -134,7 +295,6 @@ class TelescopeProductMetExtractor(MetExtractor):
             for alias in t.aliases:
                 if alias:
                     target_names.append(alias)
-        self.metadata['Targets'] = list(set(target_names))
         # @idea: another more general approach to generating a good set of targets would be
         # to use an external lookup based on sky position to find alternates:
         # >>> from astropy.coordinates import SkyCoord
@@ -146,39 +306,63 @@ class TelescopeProductMetExtractor(MetExtractor):
         # 'Az: 57:17:44.8 El: 114:35:29.6'
         # 'Ra: 3:49:10.99 Dec: 114:35:29.6'
         # Delete them with 'startswith'
+        # sorted, so that the field is the same every time it is extracted
+        return sorted(set(target_names))
+
+    def _instruction_set(self):
         try:
-            self.metadata['InstructionSet'] = '%s %s' % (self._katdata.obs_params['script_name'],
-                                                         self._katdata.obs_params['script_arguments'])
+            return '%s %s' % (self._katdata.obs_params['script_name'], self._katdata.obs_params['script_arguments'])
         except KeyError:
-            pass
+            return None
 
+    def _extract_metadata_from_katdata(self):
+        """Populate self.metadata: Get information using katdal, for the selected katdata fields.
+        The katdal summary and target fields are timed as stages of their own."""
+        for name, getter in self.katdata_fields().items():
+            if self._wants(name):
+                start_time = time.time()
+                value = getter()
+                if value is not None:
+                    self.metadata[name] = value
+                nbytes = len(value) if name == 'Details' and value is not None else None
+                self._record_stage(KATDATA_FIELD_STAGES.get(name, 'katdata'), time.time() - start_time, nbytes)
+
+    @_timed_stage('location')
     def _extract_location_from_katdata(self):
-        self.metadata["DecRa"] = []
-        self.metadata["ElAz"] = []
-
+        """Populate self.metadata: the pointing of every track and scan, as DecRa for radec targets
+        and ElAz for azel targets. Scan boundaries and target indices are taken from the unselected
+        sensor data in one pass, so the katdal selection is left untouched."""
+        if not self._wants('DecRa', 'ElAz'):
+            return
         f = self._katdata
-        f.select(scans="track,scan")
-        f.select(ants=f.ref_ant)
-
-        for i, scan, target in f.scans():
-            f.select(scans=i)
-            t = f.catalogue.targets[f.target_indices[0]]
-            if (t.body_type == 'radec'):
-                ra, dec = t.radec()
-                ra, dec = katpoint.rad2deg(ra), katpoint.rad2deg(dec)
-                self.metadata["DecRa"].append("%f, %f" % (dec, katpoint.wrap_angle(ra, 360)))
-
-            elif t.body_type == 'azel':
-                az, el = t.azel()
-                az, el = katpoint.rad2deg(az), katpoint.rad2deg(el)
-                if -90 <= el <= 90:
-                    self.metadata["ElAz"].append("%f, %f" % (el, katpoint.wrap_angle(az, 360)))
-                else:
-                    self.metadata["ElAz"].append("%f, %f" % ((np.clip(el, -90, 90)), katpoint.wrap_angle(az, 360)))
-
+        scan_state = np.asarray(f.sensor.get('Observation/scan_state', select=False))
+        scan_index = np.asarray(f.sensor.get('Observation/scan_index', select=False))
+        target_index = np.asarray(f.sensor.get('Observation/target_index', select=False))
+        # the target of each track or scan is the target at its first dump
+        tracks = np.isin(scan_state, ['track', 'scan'])
+        scans, first_dumps = np.unique(scan_index[tracks], return_index=True)
+        scan_targets = target_index[tracks][first_dumps]
+        # positions are only calculated once per target
+        target_indices, scan_target_indices = np.unique(scan_targets, return_inverse=True)
+        targets = [f.catalogue.targets[i] for i in target_indices]
+        body_types = np.array([t.body_type for t in targets], dtype=object)
+        positions = np.array([t.radec() if t.body_type == 'radec' else
+                              t.azel() if t.body_type == 'azel' else (np.nan, np.nan)
+                              for t in targets], dtype=float).reshape(-1, 2)
+        scan_body_types = body_types[scan_target_indices]
+        scan_positions = katpoint.rad2deg(positions[scan_target_indices])
+
+        ra, dec = scan_positions[scan_body_types == 'radec'].T
+        self.metadata["DecRa"] = ["%f, %f" % (d, r) for d, r in zip(dec, katpoint.wrap_angle(ra, 360))]
+        az, el = scan_positions[scan_body_types == 'azel'].T
+        self.metadata["ElAz"] = ["%f, %f" % (e, a) for e, a in zip(np.clip(el, -90, 90), katpoint.wrap_angle(az, 360))]
+
+    @_timed_stage('project')
     def _extract_metadata_for_project(self):
         """Populate self.metadata: Grab if available proposal, program block and project id's
         from the observation script arguments."""
+        if not self._wants('ProposalId', 'ProgramBlockId', 'ScheduleBlockIdCode', 'IssueId', 'ProposalDescription'):
+            return
         # ProposalId
         if 'proposal_id' in self._katdata.obs_params:
             self.metadata['ProposalId'] = self._katdata.obs_params['proposal_id']
@@ -208,25 +392,47 @@ class FileBasedTelescopeProductMetExtractor(TelescopeProductMetExtractor):
     ----------
     katdata : object : katdal object
         A valid katdal oject.
+
+    Attributes
+    ----------
+    digest_algorithm : string : hashlib algorithm used for the FileDigest.
+    digest_mmap : boolean : hash the file through a memory map rather than buffered reads.
+    digest_cache : DigestCache : persistent cache of digests keyed on file identity.
     """
+    digest_algorithm = DIGEST_ALGORITHM
+    digest_mmap = False
+    digest_cache = DigestCache()
+
     def __init__(self, katdata):
         self.katfile = os.path.abspath(katdata.file.filename)
         super(FileBasedTelescopeProductMetExtractor, self).__init__(katdata, '%s.%s' % (self.katfile, 'met',))
 
+    @_timed_stage('digest')
     def _extract_metadata_file_digest(self):
-        """Populate self.metadata: Calculate the md5 checksum and create a digest metadata key"""
+        """Populate self.metadata: Calculate the checksum and create a digest metadata key.
+        Digests are kept in the digest cache, so that a retried extraction doesn't hash the file again."""
+        if not self._wants('FileDigest'):
+            return
         md5_filename = os.path.abspath(self.katfile + '.md5')
-        if os.path.isfile(md5_filename):
+        if self.digest_algorithm == 'md5' and os.path.isfile(md5_filename):
             with open(md5_filename, 'r') as md5:
                 self.metadata['FileDigest'] = md5.read().strip()
                 logger.debug('Digest is %s.', self.metadata['FileDigest'])
+            # the sidecar is removed, so keep the digest for retries
+            self.digest_cache.put(self.katfile, 'md5', self.metadata['FileDigest'])
             os.remove(md5_filename)
+            return
+        digest = self.digest_cache.get(self.katfile, self.digest_algorithm)
+        if digest:
+            self.metadata['FileDigest'] = digest
+            logger.debug('Cached digest is %s.', self.metadata['FileDigest'])
         else:
-            logger.info('Calculating the md5 checksum for %s. This may take a while.', self.katfile)
-            p = subprocess.Popen(['md5sum', self.katfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-            if not p[1]:
-                self.metadata['FileDigest'] = p[0].split()[0]
-                logger.info('md5 checksum complete. Digest is %s.', self.metadata['FileDigest'])
+            logger.info('Calculating the %s checksum for %s. This may take a while.',
+                        self.digest_algorithm, self.katfile)
+            self.metadata['FileDigest'] = file_digest(self.katfile, self.digest_algorithm, use_mmap=self.digest_mmap)
+            self._record_stage('digest', 0.0, os.path.getsize(self.katfile))
+            self.digest_cache.put(self.katfile, self.digest_algorithm, self.metadata['FileDigest'])
+            logger.info('%s checksum complete. Digest is %s.', self.digest_algorithm, self.metadata['FileDigest'])
 
 
 class KAT7TelescopeProductMetExtractor(FileBasedTelescopeProductMetExtractor):
@@ -256,22 +462,23 @@ class KAT7TelescopeProductMetExtractor(FileBasedTelescopeProductMetExtractor):
         super(KAT7TelescopeProductMetExtractor, self).__init__(katdata)
         self.product_type = 'KAT7TelescopeProduct'
 
-    def extract_metadata(self):
+    def extract_metadata(self, fields=None):
         """Metadata to extract for this product. Test value of self.__metadata_extracted. If
-        True, this method has already been run once. If False, extract metadata.
+        True, this method has already been run once. If False, extract metadata. If fields
+        are given, only the steps producing those fields are run, even if run before.
         This includes:
             * extracting the product type
             * extracting basic hdf5 information
             * extacting project related information
             * extracting an md5 checksum
         """
-        if not self._metadata_extracted:
-            self._extract_metadata_product_type()
-            self._extract_metadata_from_katdata()
-            self._extract_metadata_for_project()
-            self._extract_metadata_file_digest()
-            self._extract_location_from_katdata()
-            self._metadata_extracted = True
+        if fields is not None or not self._metadata_extracted:
+            with self._extracting(fields):
+                self._extract_metadata_product_type()
+                self._extract_metadata_from_katdata()
+                self._extract_metadata_for_project()
+                self._extract_metadata_file_digest()
+                self._extract_location_from_katdata()
         else:
             logger.warning("Metadata already extracted. Set the metadata_extracted attribute to False and run again.")
 
@@ -311,13 +518,16 @@ class RTSTelescopeProductMetExtractor(FileBasedTelescopeProductMetExtractor):
 
     def _extract_metadata_for_auto_reduction(self):
         """Populate self.metadata with information scraped from self"""
+        if not self._wants('ReductionName'):
+            return
         metadata_key_to_map = 'ReductionName'
         obs_param_to_get = 'reduction_name'
         self.metadata[metadata_key_to_map] = self._katdata.obs_params.get(obs_param_to_get, '')
 
-    def extract_metadata(self):
+    def extract_metadata(self, fields=None):
         """Metadata to extract for this product. Test value of self.__metadata_extracted. If
-        True, this method has already been run once. If False, extract metadata.
+        True, this method has already been run once. If False, extract metadata. If fields
+        are given, only the steps producing those fields are run, even if run before.
         This includes:
             * extracting the product type
             * extracting basic hdf5 information
@@ -325,14 +535,14 @@ class RTSTelescopeProductMetExtractor(FileBasedTelescopeProductMetExtractor):
             * extracting project info
             * extracting an md5 checksum
         """
-        if not self._metadata_extracted:
-            self._extract_metadata_product_type()
-            self._extract_metadata_from_katdata()
-            self._extract_metadata_for_auto_reduction()
-            self._extract_metadata_file_digest()
-            self._extract_metadata_for_project()
-            self._extract_location_from_katdata()
-            self._metadata_extracted = True
+        if fields is not None or not self._metadata_extracted:
+            with self._extracting(fields):
+                self._extract_metadata_product_type()
+                self._extract_metadata_from_katdata()
+                self._extract_metadata_for_auto_reduction()
+                self._extract_metadata_file_digest()
+                self._extract_metadata_for_project()
+                self._extract_location_from_katdata()
         else:
             logger.warning("Metadata already extracted. Set the metadata_extracted attribute to False and run again.")
 
@@ -364,12 +574,16 @@ class MeerKATAR1TelescopeProductMetExtractor(FileBasedTelescopeProductMetExtract
         self.product_type = 'MeerKATAR1TelescopeProduct'
 
     def _extract_sub_array_details(self):
+        if not self._wants('SubarrayProductId', 'SubarrayNumber', 'SubarrayProduct'):
+            return
         self.metadata['SubarrayProductId'] = self._katdata.file['TelescopeState'].attrs['subarray_product_id']
         self.metadata['SubarrayNumber'] = str(self._katdata.file['TelescopeState'].attrs['sub_sub_nr'])
         self.metadata['SubarrayProduct'] = self._katdata.file['TelescopeState'].attrs['sub_product']
 
     def _extract_metadata_for_auto_reduction(self):
         """Populate self.metadata with information scraped from self"""
+        if not self._wants('ReductionLabel'):
+            return
         metadata_key_to_map = 'ReductionLabel'
         obs_param_to_get = 'reduction_label'
         obs_param = self._katdata.obs_params.get(obs_param_to_get)
@@ -378,24 +592,25 @@ class MeerKATAR1TelescopeProductMetExtractor(FileBasedTelescopeProductMetExtract
         if obs_param:
             self.metadata[metadata_key_to_map] = obs_param
 
-    def extract_metadata(self):
+    def extract_metadata(self, fields=None):
         """Metadata to extract for this product. Test value of self.__metadata_extracted. If
-        True, this method has already been run once. If False, extract metadata.
+        True, this method has already been run once. If False, extract metadata. If fields
+        are given, only the steps producing those fields are run, even if run before.
         This includes:
             * extracting the product type
             * extracting basic hdf5 information
             * extracting the sub array product id
             * extracting an md5 checksum
         """
-        if not self._metadata_extracted:
-            self._extract_metadata_file_digest()
-            self._extract_metadata_product_type()
-            self._extract_metadata_from_katdata()
-            self._extract_metadata_for_project()
-            self._extract_sub_array_details()
-            self._extract_metadata_for_auto_reduction()
-            self._extract_location_from_katdata()
-            self._metadata_extracted = True
+        if fields is not None or not self._metadata_extracted:
+            with self._extracting(fields):
+                self._extract_metadata_file_digest()
+                self._extract_metadata_product_type()
+                self._extract_metadata_from_katdata()
+                self._extract_metadata_for_project()
+                self._extract_sub_array_details()
+                self._extract_metadata_for_auto_reduction()
+                self._extract_location_from_katdata()
         else:
             logger.warning("Metadata already extracted. Set the metadata_extracted attribute to False and run again.")
 
@@ -407,35 +622,45 @@ class MeerKATTelescopeProductMetExtractor(TelescopeProductMetExtractor):
     ----------
     cbid_stream_rdb_file : string : The full path name of the capture stream
     rdb file.
+    katdata : katdal.DataSet : The capture stream already opened with katdal.
+    Opened from the rdb file if not given.
     """
-    def __init__(self, cbid_stream_rdb_file):
-        katdata = katdal.open(cbid_stream_rdb_file)
+    def __init__(self, cbid_stream_rdb_file, katdata=None):
+        start_time = time.time()
+        opened = katdata is None
+        if opened:
+            katdata = katdal.open(cbid_stream_rdb_file)
         metfilename = '{}.met'.format(katdata.source.data.name)
         super(MeerKATTelescopeProductMetExtractor, self).__init__(katdata, metfilename)
         self.product_type = 'MeerKATTelescopeProduct'
+        if opened:
+            self._record_stage('open', time.time() - start_time, os.path.getsize(cbid_stream_rdb_file))
 
-    def extract_metadata(self):
+    def extract_metadata(self, fields=None):
         """Metadata to extract for this product. Test value of self.__metadata_extracted. If
-        True, this method has already been run once. If False, extract metadata.
+        True, this method has already been run once. If False, extract metadata. If fields
+        are given, only the steps producing those fields are run, even if run before.
         This includes:
             * extracting the product type
             * extracting basic hdf5 information
             * extacting project related information
         """
-        if not self._metadata_extracted:
-            self._extract_metadata_product_type()
-            self._extract_metadata_from_katdata()
-            self._extract_metadata_for_project()
-            self._extract_metadata_for_capture_stream()
-            self._extract_location_from_katdata()
-            self._extract_instrument_name()
-            self._metadata_extracted = True
+        if fields is not None or not self._metadata_extracted:
+            with self._extracting(fields):
+                self._extract_metadata_product_type()
+                self._extract_metadata_from_katdata()
+                self._extract_metadata_for_project()
+                self._extract_metadata_for_capture_stream()
+                self._extract_location_from_katdata()
+                self._extract_instrument_name()
         else:
             logger.warning("Metadata already extracted. Set the metadata_extracted attribute to False and run again.")
 
     def _extract_metadata_for_capture_stream(self):
         """Extract CaptureStreamId, CaptureBlockId and StreamId.
         """
+        if not self._wants('CaptureStreamId', 'CaptureBlockId', 'StreamId', 'Prefix'):
+            return
         self.metadata['CaptureBlockId'] = self._katdata.source.metadata.attrs['capture_block_id']
         self.metadata['StreamId'] = self._katdata.source.metadata.attrs['stream_name']
         self.metadata['CaptureStreamId'] = self.metadata['CaptureBlockId'] + '_' + self.metadata['StreamId']
@@ -448,6 +673,8 @@ class MeerKATTelescopeProductMetExtractor(TelescopeProductMetExtractor):
 
     def _extract_instrument_name(self):
         """Extract the instrument from the environment variable if it exists"""
+        if not self._wants('Instrument'):
+            return
         if 'SITENAME' in os.environ:
             self.metadata['Instrument'] = os.environ['SITENAME']
 
@@ -459,33 +686,44 @@ class MeerKATFlagProductMetExtractor(MetExtractor):
     ----------
     cbid_stream_rdb_file : string : The full path name of the capture stream
     rdb file.
+    attrs : dict : The 'capture_block_id' and 'stream_name' of the capture
+    stream, e.g. a telstate or as found during detection. Only these keys are
+    read from the rdb file if not given.
     """
-    def __init__(self, cbid_stream_rdb_file):
-        self._ts = katsdptelstate.TelescopeState()
-        self._ts.load_from_file(cbid_stream_rdb_file)
-        metfilename = '{}.met'.format(self._ts['capture_block_id']+'_'+self._ts['stream_name'])
+    def __init__(self, cbid_stream_rdb_file, attrs=None):
+        start_time = time.time()
+        opened = attrs is None
+        if opened:
+            attrs = read_rdb_keys(cbid_stream_rdb_file, ['capture_block_id', 'stream_name'])
+        self._attrs = attrs
+        metfilename = '{}.met'.format(self._attrs['capture_block_id']+'_'+self._attrs['stream_name'])
         super(MeerKATFlagProductMetExtractor, self).__init__(metfilename)
         self.product_type = 'MeerKATFlagProduct'
+        if opened:
+            self._record_stage('open', time.time() - start_time)
 
-    def extract_metadata(self):
+    def extract_metadata(self, fields=None):
         """Metadata to extract for this product. Test value of self.__metadata_extracted. If
-        True, this method has already been run once. If False, extract metadata.
+        True, this method has already been run once. If False, extract metadata. If fields
+        are given, only the steps producing those fields are run, even if run before.
         This includes:
             * extracting the product type
         """
-        if not self._metadata_extracted:
-            self._extract_metadata_product_type()
-            self._extract_metadata_for_capture_stream()
-            self._extract_instrument_name()
-            self._metadata_extracted = True
+        if fields is not None or not self._metadata_extracted:
+            with self._extracting(fields):
+                self._extract_metadata_product_type()
+                self._extract_metadata_for_capture_stream()
+                self._extract_instrument_name()
         else:
             logger.warning("Metadata already extracted. Set the metadata_extracted attribute to False and run again.")
 
     def _extract_metadata_for_capture_stream(self):
         """Extract CaptureStreamId, CaptureBlockId and StreamId.
         """
-        self.metadata['CaptureBlockId'] = self._ts['capture_block_id']
-        self.metadata['StreamId'] = self._ts['stream_name']
+        if not self._wants('CaptureStreamId', 'CaptureBlockId', 'StreamId'):
+            return
+        self.metadata['CaptureBlockId'] = self._attrs['capture_block_id']
+        self.metadata['StreamId'] = self._attrs['stream_name']
         self.metadata['CaptureStreamId'] = self.metadata['CaptureBlockId'] + '_' + self.metadata['StreamId']
 
     def _extract_metadata_product_type(self):
@@ -496,10 +734,24 @@ class MeerKATFlagProductMetExtractor(MetExtractor):
     def _extract_instrument_name(self):
         """Extract the instrument from the enviroment variable if it exists.
         """
+        if not self._wants('Instrument'):
+            return
         if 'INSTRUMENT' in os.environ:
             self.metadata['Instrument'] = os.environ['INSTRUMENT']
 
 
+def metadata_field_names():
+    """Names of the metadata fields that extract_metadata can be asked for, over
+    all the extractors. The product type is always extracted.
+
+    Returns
+    -------
+    names: list : sorted field names.
+    """
+    katdata_fields = TelescopeProductMetExtractor(None, None).katdata_fields()
+    return sorted(set(katdata_fields) | set(EXTRACTOR_FIELDS))
+
+
 def file_mime_detection(katfile):
     """Function to instantiate the correct metadata extraction class. The
     following file extensions are are currently detected: '.h5' and '.rdb'.
@@ -1,16 +1,180 @@
+import logging
+import math
 import pysolr
+import re
+import requests
+import threading
 import uuid
 import os
 import urllib.parse
 import time
 import mimetypes
 
+from collections import Counter, namedtuple, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SOLR_TIMEOUT = 60
+SOLR_POOL_SIZE = 32
+# updates are left to solr to commit within this many milliseconds, lookups
+# by id use the real-time get handler and see them straight away
+SOLR_COMMIT_WITHIN = 10000
+SOLR_BATCH_SIZE = 500
+# pysolr error for a request solr rejected, rather than one that never got through
+SOLR_CLIENT_ERROR = re.compile(r'\(HTTP 4\d\d\)')
+# atomic updates that leave the document the same if they are applied twice
+SOLR_IDEMPOTENT_UPDATES = ('set', 'add-distinct', 'remove', 'removeregex')
+# copyField destinations returned with the document, left out of documents sent back to solr
+SOLR_COPY_FIELDS = ['Observer_lowercase']
+
+BulkResult = namedtuple('BulkResult', ['versions', 'errors'])
+
+_solr_session = None
+_solr_session_pid = None
+_solr_session_lock = threading.Lock()
+_atomic_update_support = {}
+_atomic_update_lock = threading.Lock()
+
 
 class MetaDataHandlerException(Exception):
     """Handle execptions generated by the metadata handler class"""
     pass
 
 
+def get_solr_session():
+    """Get the keep-alive HTTP session shared by all solr clients in this process.
+    Worker processes forked from this one create their own.
+
+    Returns
+    -------
+    session: requests.Session : a session with a pool of SOLR_POOL_SIZE connections per host.
+    """
+    global _solr_session, _solr_session_pid
+    with _solr_session_lock:
+        if _solr_session is None or _solr_session_pid != os.getpid():
+            session = requests.Session()
+            session.stream = False
+            adapter = requests.adapters.HTTPAdapter(pool_connections=SOLR_POOL_SIZE, pool_maxsize=SOLR_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _solr_session, _solr_session_pid = session, os.getpid()
+        return _solr_session
+
+
+def get_solr(solr_url):
+    """Create a solr client that uses the shared HTTP session.
+
+    Parameters
+    ----------
+    solr_url: string : solr url endpoint.
+
+    Returns
+    -------
+    solr: pysolr.Solr : the solr client.
+    """
+    solr = pysolr.Solr(solr_url, timeout=SOLR_TIMEOUT)
+    solr.session = get_solr_session()
+    return solr
+
+
+def supports_atomic_updates(solr_url):
+    """Check, once per solr core, that atomic updates can be used. Solr rebuilds
+    the document from its stored fields for an atomic update and then applies
+    copyField again, so every copyField destination must be stored=false. A stored
+    destination would get its values duplicated, or the update rejected if it is
+    single-valued. A core whose schema can't be read is assumed not to qualify,
+    and is checked again on the next call, as the failure may be an outage.
+
+    Parameters
+    ----------
+    solr_url: string : solr url endpoint.
+
+    Returns
+    -------
+    supported: boolean : True if atomic updates are safe for this core.
+    """
+    with _atomic_update_lock:
+        if solr_url not in _atomic_update_support:
+            supported = _check_copy_fields(solr_url)
+            if supported is None:
+                return False
+            _atomic_update_support[solr_url] = supported
+        return _atomic_update_support[solr_url]
+
+
+def _check_copy_fields(solr_url):
+    # True or False as read from the schema, None if it couldn't be read
+    url = solr_url.rstrip('/')
+    session = get_solr_session()
+    try:
+        resp = session.get('{}/schema/copyfields'.format(url), params={'wt': 'json'}, timeout=SOLR_TIMEOUT)
+        resp.raise_for_status()
+        for dest in sorted(set(c['dest'] for c in resp.json()['copyFields'])):
+            resp = session.get('{}/schema/fields/{}'.format(url, dest), params={'wt': 'json', 'showDefaults': 'true'},
+                               timeout=SOLR_TIMEOUT)
+            resp.raise_for_status()
+            field = resp.json()['field']
+            if field.get('stored', True) or (field.get('docValues') and field.get('useDocValuesAsStored', True)):
+                logger.info('copyField destination %s is stored in %s, writing whole documents.', dest, solr_url)
+                return False
+    except (requests.exceptions.RequestException, ValueError, KeyError) as err:
+        logger.warning('Unable to check the schema of %s, writing whole documents: %s', solr_url, err)
+        return None
+    return True
+
+
+def _met_value(value):
+    """Normalise a single metadata value for comparison. Numbers compare by value,
+    as solr returns typed values for numeric fields where the extractors format
+    them as text, e.g. 1284.0 and '1284.00'."""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return str(value)
+    if isinstance(value, str):
+        for parse in (int, float):
+            try:
+                value = parse(value)
+                break
+            except ValueError:
+                pass
+        else:
+            return value
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    return value
+
+
+def _met_values(value):
+    """Normalise a metadata value to a multiset of values for comparison, as solr
+    returns single values for some fields and typed values for others, and the
+    order of multi-valued fields, e.g. Targets, is not significant."""
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return Counter(_met_value(v) for v in value)
+
+
+def diff_prod_met(met, prod_met):
+    """Find the product metadata fields that differ from a solr document.
+    Only fields in prod_met are compared, fields missing from it are left as is.
+
+    Parameters
+    ----------
+    met: dict : metadata dict, a local copy of the solr doc.
+    prod_met: dict : newly extracted product metadata, e.g. from MetExtractor.solr_doc.
+
+    Returns
+    -------
+    changed: dict : the fields in prod_met whose values differ from met.
+    """
+    changed = {}
+    for key, value in prod_met.items():
+        # ProductName is mapped internally by OODT, and not stored in SOLR.
+        if key == 'ProductName':
+            continue
+        if key not in met or _met_values(met[key]) != _met_values(value):
+            changed[key] = value
+    return changed
+
+
 class MetaDataHandler(object):
     """Class for generating solr metadata that follows a OODT styled data product.
 
@@ -21,17 +185,25 @@ class MetaDataHandler(object):
     product_name: string : The name of the product.
     product_id: string : Unique identifier for product. If set to none,
                          product will have a self generated uuid.
+    spool: MetaDataSpool : Optional local spool for writes that can't reach solr.
+        Writes are spooled while solr is unavailable, and while earlier writes are
+        still waiting in the spool, and replayed in order later. Spooled writes keep
+        their _version_, so a new product is still only created if it doesn't exist.
+        Lookups still need solr, and fail while it is unavailable.
     """
-    def __init__(self, solr_url, product_type, product_name, product_id=None):
+    def __init__(self, solr_url, product_type, product_name, product_id=None, spool=None):
         super(MetaDataHandler, self).__init__()
         self.solr_url = solr_url
-        self.solr = pysolr.Solr(self.solr_url)
+        self.solr = get_solr(self.solr_url)
         self.product_type = product_type
         self.product_name = product_name
         if product_id:
             self.product_id = product_id
         else:
             self.product_id = str(uuid.uuid4())
+        self.spool = spool
+        # local copy of product metadata with writes waiting in the spool
+        self._spooled = {}
 
     def create_core_met(self):
         """Create the core OODT style metadata.
@@ -40,14 +212,31 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
+        return self._write(self._core_met())  # return with _version_
+
+    def begin(self, met=None):
+        """Start a transaction that gathers changes to the product metadata locally,
+        and writes them to solr in a single update on commit.
+
+        Parameters
+        ----------
+        met: dict : metadata dict, a local copy of the solr doc to update. If None,
+            start from the core metadata of a new product.
+
+        Returns
+        -------
+        transaction: MetTransaction : the transaction to gather changes in.
+        """
+        return MetTransaction(self, met)
+
+    def _core_met(self):
         new_met = {}
         new_met['id'] = self.product_id
         new_met['CAS.ProductId'] = self.product_id
         new_met['CAS.ProductName'] = self.product_name
         new_met['CAS.ProductTypeId'] = 'urn:kat:{}'.format(self.product_type)
         new_met['CAS.ProductTypeName'] = self.product_type
-        self.solr.add([new_met])
-        return self.get_prod_met(self.product_id)  # return with _version_
+        return new_met
 
     def add_ref_original(self, met, original_refs):
         """Handle original references for product and decide if its Flat or Hierarchical.
@@ -60,6 +249,11 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
+        met.update(self._ref_original_met(original_refs))
+        return self._write(met)  # return with updated _version_
+
+    def _ref_original_met(self, original_refs):
+        met = {}
         if len(original_refs) == 0:
             raise MetaDataHandlerException('No product in {}'.format(original_refs))
         elif len(original_refs) == 1:
@@ -73,8 +267,7 @@ class MetaDataHandler(object):
         met['CAS.ReferenceOriginal'] = [urllib.parse.urlparse(x).geturl() for x in sorted(original_refs)]
         met['CAS.ReferenceFileSize'] = product_sizes
         met['CAS.ReferenceMimeType'] = product_types
-        self.solr.add([met])
-        return self.get_prod_met(met['id'])  # return with updated _version_
+        return met
 
     def add_ref_datastore(self, met, datastore_refs):
         """Handle datastore references for product once ingested into the backend storage.
@@ -87,9 +280,11 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
-        met['CAS.ReferenceDatastore'] = [urllib.parse.urlparse(x).geturl() for x in sorted(datastore_refs)]
-        self.solr.add([met])
-        return self.get_prod_met(met['id'])  # return with updated _version_
+        met.update(self._ref_datastore_met(datastore_refs))
+        return self._write(met)  # return with updated _version_
+
+    def _ref_datastore_met(self, datastore_refs):
+        return {'CAS.ReferenceDatastore': [urllib.parse.urlparse(x).geturl() for x in sorted(datastore_refs)]}
 
     def set_product_transferring(self, met):
         """Set product transfer status while transfering to the backend storage.
@@ -102,10 +297,9 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
-        met['CAS.ProductReceivedTime'] = ''
-        met['CAS.ProductTransferStatus'] = 'TRANSFERRING'
-        self.solr.add([met])
-        return self.get_prod_met(met['id'])   # return with updated _version_
+        fields = self._transferring_met()
+        met.update(fields)
+        return self.atomic_update(met, fields)
 
     def set_product_received(self, met):
         """Set product transfer status once received into the backend storage.
@@ -118,10 +312,9 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
-        met['CAS.ProductReceivedTime'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-        met['CAS.ProductTransferStatus'] = 'RECEIVED'
-        self.solr.add([met])
-        return self.get_prod_met(met['id'])   # return with updated _version_
+        fields = self._received_met()
+        met.update(fields)
+        return self.atomic_update(met, fields)
 
     def add_prod_met(self, met, prod_met):
         """Add the product based metadata to solr.
@@ -130,14 +323,119 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
+        met.update(self._prod_met(prod_met))
+        return self._write(met)
+
+    def _transferring_met(self):
+        return {'CAS.ProductReceivedTime': '', 'CAS.ProductTransferStatus': 'TRANSFERRING'}
+
+    def _received_met(self):
+        return {'CAS.ProductReceivedTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'CAS.ProductTransferStatus': 'RECEIVED'}
+
+    def _prod_met(self, prod_met):
         # ProductName is mapped internally by OODT. Pop it if we're going to insert directly into SOLR.
         prod_met.pop('ProductName', None)
-        met.update(prod_met)
-        self.solr.add([met])
-        return self.get_prod_met(met['id'])
+        return prod_met
+
+    def diff_prod_met(self, met, prod_met):
+        """Find the product metadata fields that differ from a solr document,
+        see diff_prod_met."""
+        return diff_prod_met(met, prod_met)
+
+    def update_prod_met(self, met, prod_met):
+        """Update only the product metadata fields that have changed, with a solr
+        atomic update where the core supports them. The update is rejected by solr
+        if the document has been changed since met was read.
+
+        Parameters
+        ----------
+        met: dict : metadata dict, a local copy of the solr doc to update.
+        prod_met: dict : newly extracted product metadata.
+
+        Returns
+        -------
+        met: dict : metadata containing the _version_ for version tracking commits to solr.
+        changed: dict : the fields that were updated.
+        """
+        changed = self.diff_prod_met(met, prod_met)
+        if not changed:
+            return met, changed
+        return self.atomic_update(met, changed), changed
+
+    def atomic_update(self, met, set_fields=None, add_fields=None):
+        """Update some fields of the product with a solr atomic update, rather than
+        sending the whole document again. The update is rejected by solr if the
+        document has been changed since met was read. If the core can't take
+        atomic updates, see supports_atomic_updates, the whole document is sent.
+
+        Parameters
+        ----------
+        met: dict : metadata dict, a local copy of the solr doc to update.
+        set_fields: dict : fields to set, replacing their current values.
+        add_fields: dict : values to append to multi-valued fields.
+
+        Returns
+        -------
+        met: dict : metadata containing the _version_ for version tracking commits to solr.
+        """
+        set_fields = set_fields or {}
+        add_fields = add_fields or {}
+        # the document as it will be after the update, in case the update is spooled
+        updated_met = dict(met)
+        updated_met.update(set_fields)
+        for key, value in add_fields.items():
+            values = updated_met.get(key, [])
+            values = values if isinstance(values, list) else [values]
+            updated_met[key] = values + (value if isinstance(value, list) else [value])
+        if not supports_atomic_updates(self.solr_url):
+            doc = {k: v for k, v in updated_met.items() if k not in SOLR_COPY_FIELDS}
+            return self._write(doc)  # return with updated _version_
+        doc = {'id': met['id']}
+        if '_version_' in met:
+            doc['_version_'] = met['_version_']
+        doc.update(set_fields)
+        doc.update(add_fields)
+        field_updates = {k: 'set' for k in set_fields}
+        field_updates.update({k: 'add' for k in add_fields})
+        return self._write(doc, field_updates, updated_met)   # return with updated _version_
+
+    def _write(self, doc, field_updates=None, met=None):
+        """Write a document and return the product metadata with the updated _version_.
+        If the write was spooled, return met, the local copy of the document after the
+        write, which defaults to doc."""
+        if self._add([doc], fieldUpdates=field_updates):
+            return self.get_prod_met(doc['id'])
+        met = dict(doc if met is None else met)
+        met.pop('_version_', None)
+        self._spooled[doc['id']] = met
+        return dict(met)
+
+    def _add(self, docs, fieldUpdates=None):
+        """Send documents to solr, or to the spool. Return True if they went to solr."""
+        if self.spool is not None and self.spool.pending():
+            # keep the writes in order behind those already in the spool
+            self._spool_docs(docs, fieldUpdates)
+            return False
+        try:
+            # leave the commit to solr rather than forcing one for every update
+            self.solr.add(docs, fieldUpdates=fieldUpdates, commit=False, commitWithin=SOLR_COMMIT_WITHIN)
+        except pysolr.SolrError as err:
+            if self.spool is None or SOLR_CLIENT_ERROR.search(str(err)):
+                raise
+            logger.warning('Solr unavailable, spooling metadata for %s: %s', self.product_id, err)
+            self._spool_docs(docs, fieldUpdates)
+            return False
+        return True
+
+    def _spool_docs(self, docs, field_updates):
+        for doc in docs:
+            self.spool.append(self.solr_url, doc, field_updates)
 
     def get_prod_met(self, prod_id=None):
-        """Get the metadata for a product, if prod_id is not specified, use self.prod_id.
+        """Get the metadata for a product, if prod_id is not specified, use self.product_id.
+        Uses the solr real-time get handler, so updates that haven't been committed yet
+        are seen as well.
 
         Parameters
         ----------
@@ -147,18 +445,24 @@ class MetaDataHandler(object):
         -------
         met: dict : metadata containing the _version_ for version tracking commits to solr.
         """
-        copy_fields = ['Observer_lowercase']
         if not prod_id:
-            prod_id = self.prod_id
-        query = 'id:{}'.format(prod_id)
-        res = self.solr.search(query)
-        if res.hits == 0:
+            prod_id = self.product_id
+        if prod_id in self._spooled:
+            # solr is behind until the spool has been replayed
+            return dict(self._spooled[prod_id])
+        try:
+            resp = get_solr_session().get('{}/get'.format(self.solr_url.rstrip('/')),
+                                          params={'id': prod_id, 'wt': 'json'}, timeout=SOLR_TIMEOUT)
+        except requests.exceptions.RequestException as err:
+            raise pysolr.SolrError('Failed to connect to server at {}: {}'.format(self.solr_url, err))
+        if resp.status_code != 200:
+            raise pysolr.SolrError('Real-time get of {} failed (HTTP {}): {}'.format(
+                prod_id, resp.status_code, resp.text[:200]))
+        doc = resp.json().get('doc')
+        if doc is None:
             return None
-        elif res.hits > 1:
-            raise MetaDataHandlerException('{} returned for {}'.format(res.hits, query))
         # filter out copy field
-        doc = res.docs[0]
-        for c in copy_fields:
+        for c in SOLR_COPY_FIELDS:
             doc.pop(c, None)
         return doc
 
@@ -173,3 +477,221 @@ class MetaDataHandler(object):
         met = self.get_prod_met(prod_id)
         self.solr.delete(id=prod_id)
         return met
+
+
+class MetTransaction(object):
+    """Changes to the metadata of a product, gathered locally and written to
+    solr in a single update on commit. Use MetaDataHandler.begin to start one.
+
+    The update carries the _version_ of the document the changes were made to,
+    so solr rejects the commit if the document has been changed in the meantime.
+    A transaction for a new product is rejected if the product already exists.
+    New products are written whole, changes to existing products are written as
+    an atomic update of just the changed fields, where the core supports them.
+
+    Parameters
+    ----------
+    handler: MetaDataHandler : the metadata handler for the product.
+    met: dict : metadata dict, a local copy of the solr doc to update. If None,
+        start from the core metadata of a new product.
+    """
+    def __init__(self, handler, met=None):
+        super(MetTransaction, self).__init__()
+        self.handler = handler
+        if met is None:
+            self.met = handler._core_met()
+            # solr only accepts a negative version if the document doesn't exist
+            self.met['_version_'] = -1
+        else:
+            self.met = dict(met)
+        self.changed = set(self.met) if self.is_new else set()
+
+    @property
+    def pending(self):
+        """True if there are changes to commit."""
+        return bool(self.changed)
+
+    @property
+    def is_new(self):
+        """True if the transaction creates the product."""
+        return self.met.get('_version_', 0) < 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def _update(self, fields):
+        self.met.update(fields)
+        self.changed.update(fields)
+        return self
+
+    def add_ref_original(self, original_refs):
+        """Handle original references for product and decide if its Flat or Hierarchical."""
+        return self._update(self.handler._ref_original_met(original_refs))
+
+    def add_ref_datastore(self, datastore_refs):
+        """Handle datastore references for product once ingested into the backend storage."""
+        return self._update(self.handler._ref_datastore_met(datastore_refs))
+
+    def set_product_transferring(self):
+        """Set product transfer status while transfering to the backend storage."""
+        return self._update(self.handler._transferring_met())
+
+    def set_product_received(self):
+        """Set product transfer status once received into the backend storage."""
+        return self._update(self.handler._received_met())
+
+    def add_prod_met(self, prod_met):
+        """Add the product based metadata."""
+        return self._update(self.handler._prod_met(prod_met))
+
+    def commit(self):
+        """Write the gathered changes to solr, if there are any.
+
+        Returns
+        -------
+        met: dict : metadata containing the _version_ for version tracking commits to solr.
+        """
+        if self.is_new:
+            self.met = self.handler._write(self.met)  # return with updated _version_
+        elif self.changed:
+            self.met = self.handler.atomic_update(self.met, {k: self.met[k] for k in self.changed})
+        self.changed = set()
+        return self.met
+
+
+class MetaDataBulkHandler(object):
+    """Send the metadata of many products to solr in batches, e.g. all the
+    streams of a capture block or a re-extraction run, so that throughput is
+    bound by solr indexing rather than by a request per product.
+
+    A batch that solr rejects is split in half and sent again until the
+    documents at fault are found, so one bad document doesn't hold back the
+    rest of its batch. Solr applies the documents of an update in order up to
+    the one it rejects, so only documents that can safely be applied twice are
+    batched. Documents with a _version_, or with field updates such as 'add'
+    that aren't idempotent, are sent one per request, as sending one again
+    would fail on its new version or repeat the update. Connection and server
+    errors are raised.
+
+    Parameters
+    ----------
+    solr_url: string : solr url endpoint.
+    batch_size: int : maximum number of documents per update request.
+    commit_within: int : milliseconds solr may take to commit the updates.
+    """
+    def __init__(self, solr_url, batch_size=SOLR_BATCH_SIZE, commit_within=SOLR_COMMIT_WITHIN):
+        super(MetaDataBulkHandler, self).__init__()
+        self.solr_url = solr_url
+        self.batch_size = max(1, batch_size)
+        self.commit_within = commit_within
+
+    def add_prod_mets(self, mets, field_updates=None):
+        """Add or update the metadata of many products. Documents are
+        deduplicated by id, the last document for an id wins.
+
+        Parameters
+        ----------
+        mets: list : solr documents, each with an 'id'. Documents with a
+            _version_ are only accepted if they match the version in solr.
+        field_updates: dict : field name mapped to a solr atomic update, e.g.
+            'set' or 'add', for fields to update rather than replace the document.
+
+        Returns
+        -------
+        result: BulkResult : versions, the new _version_ for each product id
+            written, and errors, the error message for each product id rejected.
+        """
+        docs = OrderedDict()
+        for met in mets:
+            if met['id'] in docs:
+                logger.debug('Replacing duplicate metadata for %s.', met['id'])
+                del docs[met['id']]
+            docs[met['id']] = self._update_doc(met, field_updates) if field_updates else met
+        docs = list(docs.values())
+        repeatable = all(u in SOLR_IDEMPOTENT_UPDATES for u in (field_updates or {}).values())
+        batched = [d for d in docs if repeatable and '_version_' not in d]
+        single = [d for d in docs if not repeatable or '_version_' in d]
+        versions = {}
+        errors = {}
+        start_time = time.time()
+        for i in range(0, len(batched), self.batch_size):
+            self._send(batched[i:i + self.batch_size], versions, errors)
+        for doc in single:
+            self._send([doc], versions, errors)
+        logger.info('Sent metadata for %i products to solr in %.2f s, %i rejected.',
+                    len(docs), time.time() - start_time, len(errors))
+        return BulkResult(versions, errors)
+
+    def get_prod_mets(self, prod_ids):
+        """Get the metadata of many products with the solr real-time get handler,
+        a batch of products per request.
+
+        Parameters
+        ----------
+        prod_ids: list : the product ids to find.
+
+        Returns
+        -------
+        mets: dict : metadata containing the _version_ for each product id found.
+        """
+        prod_ids = list(OrderedDict.fromkeys(prod_ids))
+        mets = {}
+        for i in range(0, len(prod_ids), self.batch_size):
+            try:
+                # posted, as a batch of ids can be too long for a url
+                resp = get_solr_session().post('{}/get'.format(self.solr_url.rstrip('/')),
+                                               data={'ids': ','.join(prod_ids[i:i + self.batch_size]),
+                                                     'wt': 'json'},
+                                               timeout=SOLR_TIMEOUT)
+            except requests.exceptions.RequestException as err:
+                raise pysolr.SolrError('Failed to connect to server at {}: {}'.format(self.solr_url, err))
+            if resp.status_code != 200:
+                raise pysolr.SolrError('Real-time get failed (HTTP {}): {}'.format(
+                    resp.status_code, self._error_message(resp)))
+            for doc in resp.json()['response']['docs']:
+                # filter out copy field
+                for c in SOLR_COPY_FIELDS:
+                    doc.pop(c, None)
+                mets[doc['id']] = doc
+        return mets
+
+    def _update_doc(self, met, field_updates):
+        doc = {}
+        for key, value in met.items():
+            if key in field_updates:
+                doc[key] = {field_updates[key]: value}
+            else:
+                doc[key] = value
+        return doc
+
+    def _send(self, batch, versions, errors):
+        try:
+            resp = get_solr_session().post('{}/update'.format(self.solr_url.rstrip('/')), json=batch,
+                                           params={'commitWithin': self.commit_within,
+                                                   'versions': 'true', 'wt': 'json'},
+                                           timeout=SOLR_TIMEOUT)
+        except requests.exceptions.RequestException as err:
+            raise pysolr.SolrError('Failed to connect to server at {}: {}'.format(self.solr_url, err))
+        if resp.status_code == 200:
+            adds = resp.json().get('adds', [])
+            versions.update(zip(adds[::2], adds[1::2]))
+        elif resp.status_code in (400, 409):
+            # a bad document or a version conflict, find the documents at fault
+            if len(batch) > 1:
+                self._send(batch[:len(batch) // 2], versions, errors)
+                self._send(batch[len(batch) // 2:], versions, errors)
+            else:
+                errors[batch[0]['id']] = 'HTTP {}: {}'.format(resp.status_code, self._error_message(resp))
+        else:
+            raise pysolr.SolrError('Solr responded with an error (HTTP {}): {}'.format(
+                resp.status_code, self._error_message(resp)))
+
+    def _error_message(self, resp):
+        try:
+            return resp.json()['error']['msg']
+        except (ValueError, KeyError, TypeError):
+            return resp.text[:200]
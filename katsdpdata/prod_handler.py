@@ -1,5 +1,8 @@
+import http.client
 import logging
 import socket
+import threading
+import time
 
 import boto
 import boto.s3.connection
@@ -51,3 +54,145 @@ def get_s3_connection(boto_dict):
 def redact_key(s3_key):
     redacted_key = s3_key[:3] + "############" + s3_key[-3:]
     return redacted_key
+
+
+class UploadController(object):
+    """Adaptive concurrency limit and optional bandwidth cap for uploads to s3.
+
+    Uploads call acquire before and release after every PUT. Completed uploads
+    are collected over a window of window seconds, after which the concurrency
+    limit is adjusted:
+        * on transient errors (503s, socket errors) it is reduced multiplicatively,
+        * on PUT latency rising above the lowest latency seen without a gain in
+          throughput it is reduced multiplicatively,
+        * while throughput keeps rising it is increased.
+
+    Parameters
+    ----------
+    max_concurrency: int : upper limit of uploads in flight.
+    min_concurrency: int : lower limit of uploads in flight.
+    max_rate: float : optional cap on the upload rate in bytes per second.
+    window: float : seconds between adjustments of the concurrency limit.
+    """
+    INCREASE_FACTOR = 1.25
+    DECREASE_FACTOR = 0.7
+    THROUGHPUT_GAIN = 1.05
+    LATENCY_TOLERANCE = 2.0
+
+    def __init__(self, max_concurrency, min_concurrency=1, max_rate=None, window=5.0):
+        super(UploadController, self).__init__()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.concurrency = max(self.min_concurrency, min(16, max_concurrency))
+        self.max_rate = max_rate
+        self.window = window
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._last_throughput = 0.0
+        self._base_latency = None
+        self._reset_window(time.time())
+        self._rate_lock = threading.Lock()
+        self._rate_tokens = max_rate or 0
+        self._rate_time = time.time()
+
+    def acquire(self, nbytes):
+        """Wait for a free upload slot and, if capped, for bandwidth to upload nbytes.
+
+        Parameters
+        ----------
+        nbytes: int : size of the upload in bytes.
+
+        Returns
+        -------
+        start_time: float : time the upload may start, to pass on to release.
+        """
+        with self._cond:
+            while self._in_flight >= self.concurrency:
+                self._cond.wait()
+            self._in_flight += 1
+        if self.max_rate:
+            self._throttle(nbytes)
+        return time.time()
+
+    def release(self, nbytes, start_time, error=False, failed=False):
+        """Record a finished upload and free its slot.
+
+        Parameters
+        ----------
+        nbytes: int : size of the upload in bytes.
+        start_time: float : the time returned by acquire.
+        error: boolean : True if the upload failed with a transient error.
+        failed: boolean : True if the upload failed for any other reason. Only
+            the slot is freed, as the failure says nothing about the gateway.
+        """
+        now = time.time()
+        with self._cond:
+            self._in_flight -= 1
+            if error:
+                self._window_errors += 1
+            elif not failed:
+                self._window_bytes += nbytes
+                self._window_latencies.append(now - start_time)
+            if now - self._window_start >= self.window:
+                self._adjust(now)
+            self._cond.notify_all()
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_latencies = []
+        self._window_errors = 0
+
+    def _adjust(self, now):
+        throughput = self._window_bytes / (now - self._window_start)
+        latency = None
+        if self._window_latencies:
+            latency = sorted(self._window_latencies)[len(self._window_latencies) // 2]
+        concurrency = self.concurrency
+        if self._window_errors:
+            concurrency = int(concurrency * self.DECREASE_FACTOR)
+        elif (latency and self._base_latency and latency > self.LATENCY_TOLERANCE * self._base_latency and
+              throughput <= self._last_throughput):
+            concurrency = int(concurrency * self.DECREASE_FACTOR)
+        elif throughput > self.THROUGHPUT_GAIN * self._last_throughput:
+            concurrency = int(concurrency * self.INCREASE_FACTOR) + 1
+        concurrency = max(self.min_concurrency, min(self.max_concurrency, concurrency))
+        if concurrency != self.concurrency:
+            logger.debug("Upload concurrency %i -> %i (%.2f MB/s, median PUT latency %s s, %i errors).",
+                         self.concurrency, concurrency, throughput / 1e6,
+                         '%.3f' % latency if latency else 'n/a', self._window_errors)
+            self.concurrency = concurrency
+        if latency:
+            # let the baseline drift up slowly, so that it tracks a changing gateway
+            self._base_latency = latency if not self._base_latency else min(latency, self._base_latency * 1.05)
+        self._last_throughput = throughput
+        self._reset_window(now)
+
+    def _throttle(self, nbytes):
+        with self._rate_lock:
+            now = time.time()
+            # token bucket holding at most a second's worth of bytes
+            self._rate_tokens = min(self.max_rate, self._rate_tokens + (now - self._rate_time) * self.max_rate)
+            self._rate_time = now
+            self._rate_tokens -= nbytes
+            wait = -self._rate_tokens / self.max_rate if self._rate_tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def is_transient_upload_error(err):
+    """Test if an upload error is worth retrying, i.e. a network problem or
+    the gateway being overloaded, rather than a problem with the file or
+    the request.
+
+    Parameters
+    ----------
+    err: Exception : the exception raised by the upload.
+
+    Returns
+    -------
+    boolean : True if the upload should be retried.
+    """
+    if isinstance(err, boto.exception.S3ResponseError):
+        return err.status >= 500
+    return isinstance(err, (ConnectionError, socket.timeout, socket.gaierror, http.client.HTTPException))
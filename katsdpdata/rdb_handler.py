@@ -0,0 +1,299 @@
+import io
+import logging
+import struct
+
+import katsdptelstate
+
+from katsdptelstate.encoding import decode_value
+
+logger = logging.getLogger(__name__)
+
+RDB_MAGIC = b'REDIS'
+
+# rdb opcodes, see rdb.h in the redis source
+RDB_OPCODE_SLOT_INFO = 0xF4
+RDB_OPCODE_IDLE = 0xF8
+RDB_OPCODE_FREQ = 0xF9
+RDB_OPCODE_AUX = 0xFA
+RDB_OPCODE_RESIZEDB = 0xFB
+RDB_OPCODE_EXPIRETIME_MS = 0xFC
+RDB_OPCODE_EXPIRETIME = 0xFD
+RDB_OPCODE_SELECTDB = 0xFE
+RDB_OPCODE_EOF = 0xFF
+
+# rdb value types
+RDB_TYPE_STRING = 0
+RDB_TYPE_LIST = 1
+RDB_TYPE_SET = 2
+RDB_TYPE_ZSET = 3
+RDB_TYPE_HASH = 4
+RDB_TYPE_ZSET_2 = 5
+RDB_TYPE_LIST_QUICKLIST = 14
+RDB_TYPE_LIST_QUICKLIST_2 = 18
+# types serialised as a single string blob
+RDB_BLOB_TYPES = (9, 10, 11, 12, 13, 16, 17, 20)
+
+RDB_ENC_INT8 = 0
+RDB_ENC_INT16 = 1
+RDB_ENC_INT32 = 2
+RDB_ENC_LZF = 3
+
+
+class RdbHandlerException(Exception):
+    """Handle exceptions generated by the rdb handler."""
+    pass
+
+
+class RdbKeyReader(object):
+    """Streaming reader for telstate rdb files that returns only the keys it
+    is asked for. Values of all other keys, including sensor histories, are
+    skipped over without being decoded, so the caller can stop reading as
+    soon as it has what it needs.
+
+    Parameters
+    ----------
+    filename: string : full path to the rdb file.
+    """
+    def __init__(self, filename):
+        super(RdbKeyReader, self).__init__()
+        self.filename = filename
+        self._f = open(filename, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the rdb file."""
+        self._f.close()
+
+    def iter_keys(self, match=None):
+        """Iterate over the string keys in the rdb file, in file order.
+        Telstate attributes are stored as strings, sensors are not.
+
+        Parameters
+        ----------
+        match: function : called with each key name, only keys for which it
+            returns True are read. Read all string keys if None.
+
+        Returns
+        -------
+        items: generator : (key, encoded_value) tuples.
+        """
+        self._f.seek(0)
+        header = self._read(9)
+        if not header.startswith(RDB_MAGIC):
+            raise RdbHandlerException('{} is not an rdb file.'.format(self.filename))
+        while True:
+            opcode = self._read_byte()
+            if opcode == RDB_OPCODE_EOF:
+                return
+            elif opcode == RDB_OPCODE_SELECTDB:
+                self._read_length()
+            elif opcode == RDB_OPCODE_RESIZEDB:
+                self._read_length()
+                self._read_length()
+            elif opcode == RDB_OPCODE_AUX:
+                self._read_string(skip=True)
+                self._read_string(skip=True)
+            elif opcode == RDB_OPCODE_EXPIRETIME_MS:
+                self._skip(8)
+            elif opcode == RDB_OPCODE_EXPIRETIME:
+                self._skip(4)
+            elif opcode == RDB_OPCODE_IDLE:
+                self._read_length()
+            elif opcode == RDB_OPCODE_FREQ:
+                self._skip(1)
+            elif opcode == RDB_OPCODE_SLOT_INFO:
+                for i in range(3):
+                    self._read_length()
+            elif opcode > RDB_OPCODE_SLOT_INFO:
+                # functions, module data and the like never appear in telstate dumps
+                raise RdbHandlerException('Unsupported rdb opcode {} in {}.'.format(opcode, self.filename))
+            else:
+                key = self._read_string().decode('utf-8', 'replace')
+                if opcode == RDB_TYPE_STRING and (match is None or match(key)):
+                    yield key, self._read_string()
+                else:
+                    self._skip_value(opcode)
+
+    def _read(self, nbytes):
+        data = self._f.read(nbytes)
+        if len(data) < nbytes:
+            raise RdbHandlerException('{} is truncated.'.format(self.filename))
+        return data
+
+    def _read_byte(self):
+        return self._read(1)[0]
+
+    def _skip(self, nbytes):
+        self._f.seek(nbytes, io.SEEK_CUR)
+
+    def _read_length(self):
+        """Return (length, is_encoded) for an rdb length field."""
+        first = self._read_byte()
+        kind = first >> 6
+        if kind == 0:
+            return first & 0x3F, False
+        elif kind == 1:
+            return ((first & 0x3F) << 8) | self._read_byte(), False
+        elif first == 0x80:
+            return struct.unpack('>I', self._read(4))[0], False
+        elif first == 0x81:
+            return struct.unpack('>Q', self._read(8))[0], False
+        elif kind == 3:
+            return first & 0x3F, True
+        raise RdbHandlerException('Invalid length encoding {} in {}.'.format(first, self.filename))
+
+    def _read_string(self, skip=False):
+        length, encoded = self._read_length()
+        if not encoded:
+            if skip:
+                self._skip(length)
+                return None
+            return self._read(length)
+        if length == RDB_ENC_INT8:
+            return str(struct.unpack('b', self._read(1))[0]).encode()
+        elif length == RDB_ENC_INT16:
+            return str(struct.unpack('<h', self._read(2))[0]).encode()
+        elif length == RDB_ENC_INT32:
+            return str(struct.unpack('<i', self._read(4))[0]).encode()
+        elif length == RDB_ENC_LZF:
+            compressed_length = self._read_length()[0]
+            length = self._read_length()[0]
+            if skip:
+                self._skip(compressed_length)
+                return None
+            return lzf_decompress(self._read(compressed_length), length)
+        raise RdbHandlerException('Invalid string encoding {} in {}.'.format(length, self.filename))
+
+    def _skip_double(self):
+        # old style zset scores are stored as a length prefixed string, with
+        # 253, 254 and 255 standing for nan, inf and -inf
+        length = self._read_byte()
+        if length < 253:
+            self._skip(length)
+
+    def _skip_value(self, value_type):
+        if value_type == RDB_TYPE_STRING or value_type in RDB_BLOB_TYPES:
+            self._read_string(skip=True)
+        elif value_type in (RDB_TYPE_LIST, RDB_TYPE_SET, RDB_TYPE_LIST_QUICKLIST):
+            for i in range(self._read_length()[0]):
+                self._read_string(skip=True)
+        elif value_type == RDB_TYPE_ZSET:
+            for i in range(self._read_length()[0]):
+                self._read_string(skip=True)
+                self._skip_double()
+        elif value_type == RDB_TYPE_ZSET_2:
+            for i in range(self._read_length()[0]):
+                self._read_string(skip=True)
+                self._skip(8)
+        elif value_type == RDB_TYPE_HASH:
+            for i in range(2 * self._read_length()[0]):
+                self._read_string(skip=True)
+        elif value_type == RDB_TYPE_LIST_QUICKLIST_2:
+            for i in range(self._read_length()[0]):
+                self._read_length()
+                self._read_string(skip=True)
+        else:
+            raise RdbHandlerException('Unsupported rdb value type {} in {}.'.format(value_type, self.filename))
+
+
+def lzf_decompress(data, length):
+    """Decompress an LZF compressed rdb string.
+
+    Parameters
+    ----------
+    data: bytes : the compressed data.
+    length: int : length of the uncompressed data.
+
+    Returns
+    -------
+    data: bytes : the uncompressed data.
+    """
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # literal run
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+        else:
+            # back reference
+            nbytes = ctrl >> 5
+            if nbytes == 7:
+                nbytes += data[i]
+                i += 1
+            ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+            i += 1
+            if ref < 0:
+                raise RdbHandlerException('Corrupt LZF data.')
+            for j in range(nbytes + 2):
+                out.append(out[ref + j])
+    if len(out) != length:
+        raise RdbHandlerException('LZF data decompressed to {} bytes, expected {}.'.format(len(out), length))
+    return bytes(out)
+
+
+def read_rdb_keys(filename, keys):
+    """Read telstate attributes from an rdb file without loading the whole
+    file. Reading stops as soon as all the keys have been found.
+
+    Parameters
+    ----------
+    filename: string : full path to the rdb file.
+    keys: list : names of the keys to read.
+
+    Returns
+    -------
+    attrs: dict : decoded value for each key found. Missing keys are left out.
+    """
+    keys = set(keys)
+    attrs = {}
+    with RdbKeyReader(filename) as reader:
+        for key, value in reader.iter_keys(keys.__contains__):
+            attrs[key] = decode_value(value)
+            if len(attrs) == len(keys):
+                break
+    return attrs
+
+
+def read_capture_stream_attrs(filename):
+    """Read the capture block id, stream name and stream type of a capture
+    stream rdb file, stopping as soon as they have all been found.
+
+    Parameters
+    ----------
+    filename: string : full path to the capture stream rdb file.
+
+    Returns
+    -------
+    attrs: dict : 'capture_block_id', 'stream_name' and 'stream_type', where found.
+    """
+    def match(key):
+        # the stream name isn't known up front, so keep every stream type seen
+        return key in ('capture_block_id', 'stream_name') or key.endswith('stream_type')
+
+    attrs = {}
+    stream_types = {}
+    with RdbKeyReader(filename) as reader:
+        for key, value in reader.iter_keys(match):
+            if key.endswith('stream_type'):
+                stream_types[key] = value
+            else:
+                attrs[key] = decode_value(value)
+            if 'capture_block_id' in attrs and 'stream_name' in attrs:
+                stream_key = katsdptelstate.TelescopeState.join(attrs['stream_name'], 'stream_type')
+                if stream_key in stream_types:
+                    break
+    if 'stream_name' in attrs:
+        # look up the stream type the way a telstate view of the stream would
+        stream_key = katsdptelstate.TelescopeState.join(attrs['stream_name'], 'stream_type')
+        value = stream_types.get(stream_key, stream_types.get('stream_type'))
+        if value is not None:
+            attrs['stream_type'] = decode_value(value)
+    return attrs
@@ -0,0 +1,191 @@
+import logging
+import os
+import time
+
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Directories modified this close to when they were listed are listed again on
+# the next scan, as a change within the mtime granularity would go unnoticed.
+RACY_TIME_NS = 2 * 10**9
+
+ScanProgress = namedtuple('ScanProgress', ['listed', 'visited', 'pending'])
+
+
+class _DirState(object):
+    """Cached listing of a single directory.
+
+    Parameters
+    ----------
+    mtime_ns: int : directory mtime when it was listed.
+    listed_ns: int : time the directory was listed.
+    matches: list : full path to matching files in the directory.
+    subdirs: list : full path to sub-directories.
+    complete: boolean : True if the complete token is in the directory.
+    """
+    __slots__ = ('mtime_ns', 'listed_ns', 'matches', 'subdirs', 'complete')
+
+    def __init__(self, mtime_ns, listed_ns, matches, subdirs, complete):
+        self.mtime_ns = mtime_ns
+        self.listed_ns = listed_ns
+        self.matches = matches
+        self.subdirs = subdirs
+        self.complete = complete
+
+    def is_current(self, mtime_ns):
+        return mtime_ns == self.mtime_ns and self.listed_ns - mtime_ns > RACY_TIME_NS
+
+
+class ScanIndex(object):
+    """Incremental index of the files below a set of product directories.
+
+    Every directory that has been listed is remembered along with its mtime.
+    On the next scan only directories whose mtime has changed are listed
+    again, so a scan costs a stat per known directory plus a listing per
+    changed directory, rather than a listing of every file in the tree.
+    The index is kept in memory for the life of the trawler.
+
+    Directories that could not be listed before a scan timed out are kept
+    as a cursor for their product directory, and are listed first on the
+    next scan of that product.
+    """
+    def __init__(self):
+        super(ScanIndex, self).__init__()
+        self._dirs = {}
+        self._trees = {}
+        self._patterns = {}
+        self._cursors = {}
+        self._progress = {}
+
+    def scan(self, prod_dir, file_ext, write_ext, complete_token, time_out=None):
+        """Return all files in a product directory tree that end with the file
+        extension, skipping those that are still being written.
+
+        Parameters
+        ----------
+        prod_dir: string : full path to the product directory.
+        file_ext: string : file extension to match. E.g. '.npy'
+        write_ext: string : file extension of files still being written. E.g. '.writing.npy'
+        complete_token: string : name of the complete token.
+        time_out: float : stop listing changed directories after this many seconds.
+            Directories not yet listed are picked up on the next scan.
+
+        Returns
+        -------
+        file_matches: list : full path to all matching files.
+        complete: boolean : True if complete token detected. Always False while
+            there are directories still to be listed.
+        """
+        patterns = (file_ext, write_ext, complete_token)
+        if self._patterns.get(prod_dir) != patterns:
+            self.forget(prod_dir)
+            self._patterns[prod_dir] = patterns
+        start_time = time.time()
+        file_matches = []
+        complete = False
+        listed = 0
+        seen = set()
+        # ordered set of directories still to list
+        pending = {}
+        # directories left over from the previous scan are listed first
+        stack = [prod_dir] + self._cursors.pop(prod_dir, [])[::-1]
+        while stack:
+            dir_name = stack.pop()
+            if dir_name in seen or dir_name in pending:
+                continue
+            try:
+                mtime_ns = os.stat(dir_name).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            state = self._dirs.get(dir_name)
+            if state is None or not state.is_current(mtime_ns):
+                # always list at least one directory so that every scan makes progress
+                if listed and time_out is not None and time.time() - start_time > time_out:
+                    # out of time, resume from here on the next scan and
+                    # carry on with the previous listing, if there is one
+                    pending[dir_name] = None
+                    if state is None:
+                        continue
+                else:
+                    state = self._list_dir(dir_name, mtime_ns, patterns)
+                    if state is None:
+                        continue
+                    self._dirs[dir_name] = state
+                    listed += 1
+            seen.add(dir_name)
+            file_matches.extend(state.matches)
+            complete = complete or state.complete
+            stack.extend(state.subdirs)
+        # every known directory has been visited, so prune those that have gone
+        for dir_name in self._trees.get(prod_dir, set()) - seen:
+            self._dirs.pop(dir_name, None)
+        self._trees[prod_dir] = seen
+        if prod_dir not in seen and prod_dir not in pending:
+            # product directory has been cleaned up or moved
+            self.forget(prod_dir)
+            return ([], False,)
+        self._progress[prod_dir] = ScanProgress(listed, len(seen), len(pending))
+        if pending:
+            self._cursors[prod_dir] = list(pending)
+            # don't trust the complete token until every directory has been listed
+            complete = False
+            logger.info('Scan of %s timed out after listing %i directories. %i of %i directories '
+                        'still to list on the next scan.', prod_dir, listed, len(pending), len(seen))
+        else:
+            logger.debug('Listed %i of %i directories in %s.', listed, len(seen), prod_dir)
+        return (file_matches, complete,)
+
+    def progress(self, prod_dir=None):
+        """Report how far through the product directory trees the last scans got.
+
+        Parameters
+        ----------
+        prod_dir: string : full path to a product directory. If None, report
+            the total over all product directories.
+
+        Returns
+        -------
+        progress: ScanProgress : directories listed and visited in the last scan,
+            and directories still pending a listing.
+        """
+        if prod_dir is not None:
+            return self._progress.get(prod_dir, ScanProgress(0, 0, 0))
+        return ScanProgress(*(sum(p[i] for p in self._progress.values()) for i in range(3)))
+
+    def forget(self, prod_dir):
+        """Drop a product directory tree from the index, e.g. once it has been
+        cleaned up or moved to the failed directory.
+
+        Parameters
+        ----------
+        prod_dir: string : full path to the product directory.
+        """
+        for dir_name in self._trees.pop(prod_dir, set()):
+            self._dirs.pop(dir_name, None)
+        self._dirs.pop(prod_dir, None)
+        self._patterns.pop(prod_dir, None)
+        self._cursors.pop(prod_dir, None)
+        self._progress.pop(prod_dir, None)
+
+    def _list_dir(self, dir_name, mtime_ns, patterns):
+        file_ext, write_ext, complete_token = patterns
+        listed_ns = time.time_ns()
+        matches = []
+        subdirs = []
+        complete = False
+        try:
+            with os.scandir(dir_name) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith(write_ext):
+                        # still being written to; ignore
+                        continue
+                    elif entry.name.endswith(file_ext):
+                        matches.append(entry.path)
+                    elif entry.name.endswith(complete_token):
+                        complete = True
+        except FileNotFoundError:
+            return None
+        return _DirState(mtime_ns, listed_ns, matches, subdirs, complete)
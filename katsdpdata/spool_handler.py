@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import closing
+
+import pysolr
+
+from .met_handler import MetaDataBulkHandler
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PATH = os.environ.get('KATSDPDATA_METADATA_SPOOL',
+                            os.path.expanduser('~/.local/share/katsdpdata/metadata_spool.sqlite'))
+SPOOL_REPLAY_BATCH = 500
+SPOOL_REPLAY_INTERVAL = 20
+
+
+class SpoolHandlerException(Exception):
+    """Handle exceptions generated by the spool handler."""
+    pass
+
+
+class MetaDataSpool(object):
+    """Durable local journal of metadata writes, for when solr is slow or
+    unavailable. Writes are kept in a sqlite store in the order they were made,
+    and replayed to solr in that order.
+
+    Products are deleted from the trawl directory once their metadata has been
+    spooled, so the store must be on persistent local storage, not on a tmpfs or
+    a cache directory that may be cleared.
+
+    Writes that conflict with the document in solr, e.g. the creation of a
+    product that already exists, are not applied. They are kept in the store for
+    review, together with any later writes to the same product.
+
+    Parameters
+    ----------
+    path: string : path to the sqlite store.
+    """
+    def __init__(self, path=SPOOL_PATH):
+        super(MetaDataSpool, self).__init__()
+        self.path = path
+        self._db_ready = False
+        # replays must not overlap, or writes could be applied twice
+        self._replay_lock = threading.Lock()
+
+    def append(self, solr_url, doc, field_updates=None):
+        """Add a write to the end of the spool.
+
+        Parameters
+        ----------
+        solr_url: string : solr url endpoint to write to.
+        doc: dict : the solr document, with an 'id'.
+        field_updates: dict : solr atomic updates for the fields of doc, e.g. {'field': 'set'}.
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute('INSERT INTO writes (solr_url, doc, field_updates, created) VALUES (?, ?, ?, ?)',
+                         (solr_url, json.dumps(doc), json.dumps(field_updates or {}), time.time()))
+
+    def pending(self):
+        """Return the number of writes still to be replayed."""
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT COUNT(*) FROM writes').fetchone()[0]
+
+    def conflicts(self):
+        """Return the writes held back because they conflict with solr.
+
+        Returns
+        -------
+        conflicts: list : (product id, solr url, error) tuples, in the order the writes were made.
+        """
+        with closing(self._connect()) as conn:
+            return conn.execute('SELECT prod_id, solr_url, error FROM conflicts ORDER BY seq').fetchall()
+
+    def replay(self, max_writes=SPOOL_REPLAY_BATCH):
+        """Apply the oldest spooled writes to solr, in order. Consecutive writes to
+        different products are sent together in bulk. Writes that conflict with
+        solr (HTTP 409), and later writes to the same products, are moved to the
+        conflicts kept for review. Other writes that solr rejects are logged and
+        dropped, as retrying them would fail again.
+
+        Parameters
+        ----------
+        max_writes: int : maximum number of writes to replay.
+
+        Returns
+        -------
+        replayed: int : number of writes removed from the spool.
+        """
+        with self._replay_lock:
+            with closing(self._connect()) as conn:
+                rows = conn.execute('SELECT seq, solr_url, doc, field_updates, created FROM writes '
+                                    'ORDER BY seq LIMIT ?', (max_writes,)).fetchall()
+            replayed = 0
+            for last_seq, solr_url, writes, field_updates in self._group_writes(rows):
+                conflicted = self._conflicted_ids(solr_url)
+                docs = [doc for seq, doc, created in writes if doc['id'] not in conflicted]
+                errors = {}
+                if docs:
+                    # raises on connection errors, leaving the writes for the next replay
+                    errors = MetaDataBulkHandler(solr_url).add_prod_mets(docs, field_updates or None).errors
+                with closing(self._connect()) as conn, conn:
+                    for seq, doc, created in writes:
+                        if doc['id'] in conflicted:
+                            error = 'held behind an earlier conflicting write'
+                        else:
+                            error = errors.get(doc['id'])
+                            if not error:
+                                continue
+                            if not error.startswith('HTTP 409'):
+                                logger.error('Dropped spooled metadata write for %s: %s', doc['id'], error)
+                                continue
+                        logger.error('Spooled metadata write for %s conflicts with solr, kept for review: %s',
+                                     doc['id'], error)
+                        conn.execute('INSERT INTO conflicts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (seq, solr_url, doc['id'], json.dumps(doc), json.dumps(field_updates),
+                                      created, error))
+                    conn.execute('DELETE FROM writes WHERE seq <= ?', (last_seq,))
+                replayed += len(writes)
+            if replayed:
+                logger.info('Replayed %i spooled metadata writes to solr.', replayed)
+            return replayed
+
+    def _conflicted_ids(self, solr_url):
+        with closing(self._connect()) as conn:
+            return set(row[0] for row in conn.execute('SELECT DISTINCT prod_id FROM conflicts WHERE solr_url = ?',
+                                                      (solr_url,)))
+
+    def _group_writes(self, rows):
+        # split the writes into runs that can be sent as a single bulk update
+        # without changing the order of the writes to any one product
+        group = None
+        for seq, solr_url, doc, field_updates, created in rows:
+            doc = json.loads(doc)
+            field_updates = json.loads(field_updates)
+            if (group is None or group[1] != solr_url or group[3] != field_updates or
+                    doc['id'] in group[4]):
+                if group is not None:
+                    yield group[:4]
+                group = [seq, solr_url, [], field_updates, set()]
+            group[0] = seq
+            group[2].append((seq, doc, created))
+            group[4].add(doc['id'])
+        if group is not None:
+            yield group[:4]
+
+    def _connect(self):
+        if not self._db_ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # a connection per call keeps the spool safe to use from several threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._db_ready:
+            with conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS writes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                             'solr_url TEXT, doc TEXT, field_updates TEXT, created REAL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS conflicts (seq INTEGER PRIMARY KEY, solr_url TEXT, '
+                             'prod_id TEXT, doc TEXT, field_updates TEXT, created REAL, error TEXT)')
+            self._db_ready = True
+        return conn
+
+
+class SpoolReplayer(threading.Thread):
+    """Background thread that drains a metadata spool into solr whenever solr
+    is reachable.
+
+    Parameters
+    ----------
+    spool: MetaDataSpool : the spool to replay.
+    interval: float : seconds to wait between attempts while solr is unavailable
+        or the spool is empty.
+    """
+    def __init__(self, spool, interval=SPOOL_REPLAY_INTERVAL):
+        super(SpoolReplayer, self).__init__(name='spool-replayer', daemon=True)
+        self.spool = spool
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                while self.spool.replay() and not self._stop_event.is_set():
+                    pass
+            except (pysolr.SolrError, OSError, sqlite3.Error) as err:
+                logger.warning('Spooled metadata not replayed, %i writes pending: %s',
+                               self._pending(), err)
+            self._stop_event.wait(self.interval)
+
+    def _pending(self):
+        try:
+            return self.spool.pending()
+        except sqlite3.Error:
+            return -1
+
+    def stop(self):
+        """Stop replaying, after the current batch of writes."""
+        self._stop_event.set()
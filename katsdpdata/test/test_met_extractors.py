@@ -0,0 +1,67 @@
+"""Tests for the metadata extractors."""
+
+import inspect
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+from katsdpdata import met_extractors
+from katsdpdata.met_extractors import CAS_XMLNS, MetExtractor, metadata_field_names
+
+
+class TestMetadataFieldNames(unittest.TestCase):
+    def test_names(self):
+        names = metadata_field_names()
+        self.assertEqual(names, sorted(set(names)))
+        for name in ('Targets', 'Details', 'FileDigest', 'DecRa', 'CaptureStreamId', 'Instrument'):
+            self.assertIn(name, names)
+        self.assertNotIn('ProductType', names)
+
+    def test_every_selectable_field(self):
+        # every field an extraction step can be selected by is a valid name
+        source = inspect.getsource(met_extractors)
+        wanted = set()
+        for args in re.findall(r'_wants\(([^)]*)\)', source):
+            wanted.update(re.findall(r"'([^']+)'", args))
+        self.assertTrue(wanted)
+        self.assertEqual(wanted - set(metadata_field_names()), set())
+
+
+class TestWriteMetadataFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.extractor = MetExtractor(os.path.join(self.tmp_dir, 'product.met'))
+        self.extractor.metadata = {'Observer': 'Jos\u00e9', 'Targets': ['M\u00f8ller', '', 'PKS <1934>'],
+                                   'Description': '\u65e5\u672c'}
+        self.extractor._metadata_extracted = True
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_xml_round_trip(self):
+        self.extractor.write_metadatafile('xml')
+        with open(self.extractor.metadata_filename, 'rb') as f:
+            data = f.read()
+        # non-ascii characters are written as character references, as ElementTree did
+        self.assertIn(b'Jos&#233;', data)
+        data.decode('ascii')
+        root = ET.fromstring(data)
+        met = {kv.find('key').text: [v.text or '' for v in kv.findall('val')] for kv in root}
+        self.assertEqual(root.tag, '{%s}metadata' % (CAS_XMLNS,))
+        self.assertEqual(met, {'Observer': ['Jos\u00e9'], 'Targets': ['M\u00f8ller', '', 'PKS <1934>'],
+                               'Description': ['\u65e5\u672c']})
+
+    def test_json_round_trip(self):
+        self.extractor.write_metadatafile('json')
+        with open(os.path.join(self.tmp_dir, 'product.json'), 'rb') as f:
+            data = f.read()
+        self.assertEqual(json.loads(data.decode('ascii')), self.extractor.metadata)
+
+    def test_not_extracted(self):
+        self.extractor._metadata_extracted = False
+        with self.assertRaises(met_extractors.MetExtractorException):
+            self.extractor.write_metadatafile('xml')
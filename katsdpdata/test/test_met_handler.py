@@ -0,0 +1,85 @@
+"""Tests for the solr metadata handler."""
+
+import os
+import unittest
+
+import requests
+
+from katsdpdata import met_handler
+from katsdpdata.met_handler import diff_prod_met, supports_atomic_updates
+
+SOLR_URL = 'http://solr/core'
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self._body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._body
+
+
+class FakeSchemaSession(object):
+    """Session serving the schema API, or failing while solr is down."""
+    def __init__(self, stored):
+        self.stored = stored
+        self.down = False
+        self.requests = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.requests += 1
+        if self.down:
+            raise requests.exceptions.RequestException('Connection refused')
+        if url.endswith('/schema/copyfields'):
+            return FakeResponse({'copyFields': [{'source': 'Observer', 'dest': 'Observer_lowercase'}]})
+        return FakeResponse({'field': {'name': 'Observer_lowercase', 'stored': self.stored}})
+
+
+class TestSupportsAtomicUpdates(unittest.TestCase):
+    def setUp(self):
+        met_handler._atomic_update_support.clear()
+
+    def tearDown(self):
+        met_handler._atomic_update_support.clear()
+        met_handler._solr_session, met_handler._solr_session_pid = None, None
+
+    def _session(self, stored):
+        session = FakeSchemaSession(stored)
+        met_handler._solr_session, met_handler._solr_session_pid = session, os.getpid()
+        return session
+
+    def test_unstored_copy_fields(self):
+        session = self._session(stored=False)
+        self.assertTrue(supports_atomic_updates(SOLR_URL))
+        self.assertTrue(supports_atomic_updates(SOLR_URL))
+        self.assertEqual(session.requests, 2)
+
+    def test_stored_copy_fields(self):
+        session = self._session(stored=True)
+        self.assertFalse(supports_atomic_updates(SOLR_URL))
+        self.assertFalse(supports_atomic_updates(SOLR_URL))
+        self.assertEqual(session.requests, 2)
+
+    def test_outage_not_cached(self):
+        session = self._session(stored=False)
+        session.down = True
+        self.assertFalse(supports_atomic_updates(SOLR_URL))
+        session.down = False
+        self.assertTrue(supports_atomic_updates(SOLR_URL))
+
+
+class TestDiffProdMet(unittest.TestCase):
+    def test_unchanged(self):
+        met = {'id': 'p', 'Targets': ['3C286', 'PKS1934-638'], 'CenterFrequency': 1284.0, 'NumFreqChannels': 4096,
+               'Observer': 'someone'}
+        prod_met = {'Targets': ['PKS1934-638', '3C286'], 'CenterFrequency': '1284.00', 'NumFreqChannels': '4096',
+                    'Observer': ['someone'], 'ProductName': 'p'}
+        self.assertEqual(diff_prod_met(met, prod_met), {})
+
+    def test_changed(self):
+        met = {'id': 'p', 'Targets': ['3C286', '3C286'], 'CenterFrequency': 1284.0, 'Observer': 'someone'}
+        prod_met = {'Targets': ['3C286'], 'CenterFrequency': '1284.01', 'Observer': '1284', 'Duration': '10.0'}
+        self.assertEqual(diff_prod_met(met, prod_met), prod_met)
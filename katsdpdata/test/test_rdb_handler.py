@@ -0,0 +1,110 @@
+"""Tests for the streaming rdb key reader."""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from katsdpdata.rdb_handler import RdbHandlerException, RdbKeyReader, lzf_decompress
+
+# 'abc' as a literal run followed by an overlapping back reference of 6 bytes
+LZF_SHORT = (b'\x02abc\x80\x02', b'abcabcabc')
+# a back reference of 20 bytes, which needs the extended length byte
+LZF_LONG = (b'\x03abcd\xe0\x0b\x03', b'abcd' * 6)
+
+
+def rdb_length(length):
+    if length < 64:
+        return bytes([length])
+    elif length < 16384:
+        return bytes([0x40 | (length >> 8), length & 0xFF])
+    return b'\x80' + struct.pack('>I', length)
+
+
+def rdb_string(value):
+    return rdb_length(len(value)) + value
+
+
+def rdb_lzf_string(compressed, data):
+    return b'\xc3' + rdb_length(len(compressed)) + rdb_length(len(data)) + compressed
+
+
+class TestLzfDecompress(unittest.TestCase):
+    def test_back_references(self):
+        for compressed, data in (LZF_SHORT, LZF_LONG):
+            self.assertEqual(lzf_decompress(compressed, len(data)), data)
+
+    def test_wrong_length(self):
+        with self.assertRaises(RdbHandlerException):
+            lzf_decompress(LZF_SHORT[0], 8)
+
+    def test_corrupt_reference(self):
+        with self.assertRaises(RdbHandlerException):
+            lzf_decompress(b'\x00a\x20\x05', 4)
+
+
+class TestRdbKeyReader(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.rdb')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, *records):
+        with open(self.filename, 'wb') as f:
+            f.write(b'REDIS0009')
+            f.write(b'\xfa' + rdb_string(b'redis-ver') + rdb_string(b'5.0.7'))
+            f.write(b'\xfa' + rdb_string(b'ctime') + b'\xc2' + struct.pack('<i', 1234567890))
+            f.write(b'\xfe\x00\xfb' + rdb_length(len(records)) + b'\x00')
+            for record in records:
+                f.write(record)
+            f.write(b'\xff' + bytes(8))
+
+    def _read(self, match=None):
+        with RdbKeyReader(self.filename) as reader:
+            return list(reader.iter_keys(match))
+
+    def test_strings(self):
+        self._write(b'\x00' + rdb_string(b'plain') + rdb_string(b'value'),
+                    b'\x00' + rdb_string(b'lzf') + rdb_lzf_string(*LZF_SHORT),
+                    b'\x00' + rdb_string(b'int8') + b'\xc0\xfb',
+                    b'\x00' + rdb_string(b'int16') + b'\xc1' + struct.pack('<h', 1000),
+                    b'\x00' + rdb_string(b'long') + rdb_string(b'x' * 1000),
+                    b'\xfc' + bytes(8) + b'\x00' + rdb_string(b'expiring') + rdb_string(b'soon'))
+        self.assertEqual(self._read(), [('plain', b'value'), ('lzf', LZF_SHORT[1]), ('int8', b'-5'),
+                                        ('int16', b'1000'), ('long', b'x' * 1000), ('expiring', b'soon')])
+
+    def test_skipped_types(self):
+        # sensors and other non-string values are skipped without being decoded
+        zset2 = b'\x05' + rdb_string(b'sensor') + rdb_length(2)
+        zset2 += rdb_string(b'\x00' * 20) + struct.pack('<d', 1.0)
+        zset2 += rdb_lzf_string(*LZF_LONG) + struct.pack('<d', 2.0)
+        zset = b'\x03' + rdb_string(b'old_sensor') + rdb_length(3)
+        zset += rdb_string(b'a') + rdb_string(b'1.5') + rdb_string(b'b') + b'\xfe' + rdb_string(b'c') + b'\xfd'
+        hash_ = b'\x04' + rdb_string(b'hash') + rdb_length(1) + rdb_string(b'field') + rdb_string(b'value')
+        list_ = b'\x01' + rdb_string(b'list') + rdb_length(2) + rdb_string(b'a') + b'\xc0\x01'
+        quicklist2 = b'\x12' + rdb_string(b'quicklist') + rdb_length(1) + rdb_length(2) + rdb_string(b'listpack')
+        blob = b'\x10' + rdb_string(b'listpack_hash') + rdb_lzf_string(*LZF_SHORT)
+        self._write(zset2, zset, hash_, list_, quicklist2, blob,
+                    b'\xf8' + rdb_length(100) + b'\xf9\x05' + b'\x00' + rdb_string(b'attr') + rdb_string(b'found'))
+        self.assertEqual(self._read(), [('attr', b'found')])
+
+    def test_match(self):
+        self._write(b'\x00' + rdb_string(b'skipped') + rdb_lzf_string(*LZF_LONG),
+                    b'\x00' + rdb_string(b'wanted') + rdb_string(b'value'))
+        self.assertEqual(self._read(lambda key: key == 'wanted'), [('wanted', b'value')])
+
+    def test_not_rdb(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'NOT AN RDB FILE')
+        with self.assertRaises(RdbHandlerException):
+            self._read()
+
+    def test_truncated(self):
+        self._write(b'\x00' + rdb_string(b'key') + rdb_string(b'value'))
+        with open(self.filename, 'r+b') as f:
+            f.truncate(os.path.getsize(self.filename) - 15)
+        with self.assertRaises(RdbHandlerException):
+            self._read()
@@ -0,0 +1,105 @@
+"""Tests for the incremental directory scan index."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from katsdpdata.scan_handler import RACY_TIME_NS, ScanIndex
+
+
+class TestScanIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prod_dir = os.path.join(self.tmp_dir, '1234567890-sdp-l0')
+        os.makedirs(os.path.join(self.prod_dir, 'chunks'))
+        self.index = ScanIndex()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _touch(self, *path):
+        filename = os.path.join(self.prod_dir, *path)
+        with open(filename, 'w'):
+            pass
+        return filename
+
+    def _age(self, *path):
+        # move the mtime well outside the racy window
+        old = time.time_ns() - 10 * RACY_TIME_NS
+        os.utime(os.path.join(self.prod_dir, *path), ns=(old, old))
+
+    def _scan(self):
+        return self.index.scan(self.prod_dir, '.npy', '.writing.npy', 'complete')
+
+    def test_matches(self):
+        npy = self._touch('chunks', '0.npy')
+        self._touch('chunks', '1.writing.npy')
+        self._touch('complete')
+        files, complete = self._scan()
+        self.assertEqual(files, [npy])
+        self.assertTrue(complete)
+
+    def test_racy_directories_converge(self):
+        self._touch('chunks', '0.npy')
+        self._scan()
+        self.assertEqual(self.index.progress(self.prod_dir).listed, 2)
+        # both directories were modified within the racy window, so are listed again
+        self._scan()
+        self.assertEqual(self.index.progress(self.prod_dir).listed, 2)
+        self._age()
+        self._age('chunks')
+        self._scan()
+        self.assertEqual(self.index.progress(self.prod_dir).listed, 2)
+        # unchanged and no longer racy, so only stat'ed
+        files, complete = self._scan()
+        self.assertEqual(self.index.progress(self.prod_dir).listed, 0)
+        self.assertEqual(self.index.progress(self.prod_dir).visited, 2)
+        self.assertEqual(len(files), 1)
+
+    def test_new_file_in_unchanged_tree(self):
+        self._touch('chunks', '0.npy')
+        self._age('chunks')
+        self._age()
+        self._scan()
+        self._scan()
+        self.assertEqual(self.index.progress(self.prod_dir).listed, 0)
+        npy = self._touch('chunks', '1.npy')
+        files, complete = self._scan()
+        self.assertIn(npy, files)
+        self.assertEqual(self.index.progress(self.prod_dir).listed, 1)
+
+    def test_deletions(self):
+        npy = self._touch('chunks', '0.npy')
+        self._touch('1.npy')
+        self._scan()
+        os.unlink(os.path.join(self.prod_dir, '1.npy'))
+        files, complete = self._scan()
+        self.assertEqual(files, [npy])
+        shutil.rmtree(os.path.join(self.prod_dir, 'chunks'))
+        files, complete = self._scan()
+        self.assertEqual(files, [])
+        self.assertEqual(self.index.progress(self.prod_dir).visited, 1)
+        self.assertNotIn(os.path.join(self.prod_dir, 'chunks'), self.index._dirs)
+        shutil.rmtree(self.prod_dir)
+        self.assertEqual(self._scan(), ([], False))
+        self.assertEqual(self.index._dirs, {})
+
+    def test_resume_after_time_out(self):
+        for i in range(5):
+            os.makedirs(os.path.join(self.prod_dir, 'chunks', str(i)))
+            self._touch('chunks', str(i), '0.npy')
+            self._age('chunks', str(i))
+        self._touch('complete')
+        self._age('chunks')
+        self._age()
+        files, complete = self.index.scan(self.prod_dir, '.npy', '.writing.npy', 'complete', time_out=0)
+        self.assertFalse(complete)
+        self.assertGreater(self.index.progress(self.prod_dir).pending, 0)
+        for i in range(10):
+            files, complete = self.index.scan(self.prod_dir, '.npy', '.writing.npy', 'complete', time_out=0)
+            if not self.index.progress(self.prod_dir).pending:
+                break
+        self.assertTrue(complete)
+        self.assertEqual(len(files), 5)
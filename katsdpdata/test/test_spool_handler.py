@@ -0,0 +1,98 @@
+"""Tests for the local spool of metadata writes."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pysolr
+
+from katsdpdata import spool_handler
+from katsdpdata.met_handler import BulkResult
+from katsdpdata.spool_handler import MetaDataSpool
+
+SOLR_URL = 'http://solr/core'
+
+
+class FakeBulkHandler(object):
+    """Records the bulk updates sent to solr, rejecting some products."""
+    updates = []
+    errors = {}
+    down = False
+
+    def __init__(self, solr_url):
+        self.solr_url = solr_url
+
+    def add_prod_mets(self, docs, field_updates=None):
+        if self.down:
+            raise pysolr.SolrError('Failed to connect to server at {}'.format(self.solr_url))
+        self.updates.append([doc['id'] for doc in docs])
+        errors = {doc['id']: self.errors[doc['id']] for doc in docs if doc['id'] in self.errors}
+        return BulkResult({doc['id']: 1 for doc in docs if doc['id'] not in errors}, errors)
+
+
+class TestMetaDataSpool(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spool = MetaDataSpool(os.path.join(self.tmp_dir, 'spool.sqlite'))
+        self._bulk_handler = spool_handler.MetaDataBulkHandler
+        spool_handler.MetaDataBulkHandler = FakeBulkHandler
+        FakeBulkHandler.updates = []
+        FakeBulkHandler.errors = {}
+        FakeBulkHandler.down = False
+
+    def tearDown(self):
+        spool_handler.MetaDataBulkHandler = self._bulk_handler
+        shutil.rmtree(self.tmp_dir)
+
+    def _append(self, *prod_ids):
+        for prod_id in prod_ids:
+            self.spool.append(SOLR_URL, {'id': prod_id, 'CAS.ProductTransferStatus': 'RECEIVED'})
+
+    def test_replay_in_order(self):
+        # a second write to a product starts a new bulk update
+        self._append('a', 'b', 'a', 'c')
+        self.assertEqual(self.spool.replay(), 4)
+        self.assertEqual(FakeBulkHandler.updates, [['a', 'b'], ['a', 'c']])
+        self.assertEqual(self.spool.pending(), 0)
+        self.assertEqual(self.spool.conflicts(), [])
+
+    def test_conflicts_hold_later_writes(self):
+        FakeBulkHandler.errors = {'a': 'HTTP 409: version conflict for a'}
+        self._append('a', 'b', 'a', 'b')
+        self.assertEqual(self.spool.replay(), 4)
+        # the second write to a is never sent, as it would apply on top of the wrong document
+        self.assertEqual(FakeBulkHandler.updates, [['a', 'b'], ['b']])
+        self.assertEqual([(prod_id, error) for prod_id, solr_url, error in self.spool.conflicts()],
+                         [('a', 'HTTP 409: version conflict for a'), ('a', 'held behind an earlier conflicting write')])
+        # writes spooled later are held too, even once solr would accept them
+        FakeBulkHandler.errors = {}
+        self._append('a', 'c')
+        self.assertEqual(self.spool.replay(), 2)
+        self.assertEqual(FakeBulkHandler.updates[-1], ['c'])
+        self.assertEqual(len(self.spool.conflicts()), 3)
+        self.assertEqual(self.spool.pending(), 0)
+
+    def test_rejected_writes_dropped(self):
+        FakeBulkHandler.errors = {'a': 'HTTP 400: unknown field'}
+        self._append('a', 'b', 'a')
+        self.assertEqual(self.spool.replay(), 3)
+        self.assertEqual(FakeBulkHandler.updates, [['a', 'b'], ['a']])
+        self.assertEqual(self.spool.conflicts(), [])
+
+    def test_outage_keeps_writes(self):
+        self._append('a', 'b')
+        FakeBulkHandler.down = True
+        with self.assertRaises(pysolr.SolrError):
+            self.spool.replay()
+        self.assertEqual(self.spool.pending(), 2)
+        FakeBulkHandler.down = False
+        self.assertEqual(self.spool.replay(), 2)
+        self.assertEqual(FakeBulkHandler.updates, [['a', 'b']])
+
+    def test_replay_batch(self):
+        self._append('a', 'b', 'c')
+        self.assertEqual(self.spool.replay(max_writes=2), 2)
+        self.assertEqual(self.spool.pending(), 1)
+        self.assertEqual(self.spool.replay(), 1)
+        self.assertEqual(FakeBulkHandler.updates, [['a', 'b'], ['c']])
@@ -0,0 +1,91 @@
+"""Tests for re-extracting archived products with tel_prod_met_extractor."""
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+
+from katsdpdata.met_extractors import MetExtractor
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', '..', 'scripts', 'tel_prod_met_extractor.py')
+spec = importlib.util.spec_from_file_location('tel_prod_met_extractor', SCRIPT)
+tel_prod_met_extractor = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tel_prod_met_extractor)
+
+
+class FakeExtractor(MetExtractor):
+    """MeerKAT style extractor, where the capture stream fields come from one step."""
+    def __init__(self):
+        super(FakeExtractor, self).__init__('1234567890_sdp_l0.met')
+        self.product_type = 'MeerKATTelescopeProduct'
+
+    def extract_metadata(self, fields=None):
+        with self._extracting(fields):
+            self.metadata['CAS.ProductTypeName'] = self.product_type
+            if self._wants('CaptureStreamId', 'CaptureBlockId', 'StreamId', 'Prefix'):
+                self.metadata.update(CaptureBlockId='1234567890', StreamId='sdp_l0',
+                                     CaptureStreamId='1234567890_sdp_l0', Prefix='1234567890-sdp-l0')
+            if self._wants('Targets'):
+                self.metadata['Targets'] = ['PKS1934-638', '3C286']
+            if self._wants('CenterFrequency'):
+                self.metadata['CenterFrequency'] = '1284.00'
+
+
+class FakeBulkHandler(object):
+    archived = {}
+
+    def __init__(self, solr_url):
+        pass
+
+    def get_prod_mets(self, prod_ids):
+        return {prod_id: self.archived[prod_id] for prod_id in prod_ids if prod_id in self.archived}
+
+
+class TestReextract(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.katfile = os.path.join(self.tmp_dir, '1234567890_sdp_l0.rdb')
+        with open(self.katfile, 'wb') as f:
+            f.write(b'rdb')
+        self._saved = {name: getattr(tel_prod_met_extractor, name)
+                       for name in ('file_mime_detection', 'MetaDataBulkHandler', 'get_solr')}
+        tel_prod_met_extractor.file_mime_detection = lambda katfile: FakeExtractor()
+        tel_prod_met_extractor.MetaDataBulkHandler = FakeBulkHandler
+        tel_prod_met_extractor.get_solr = lambda solr_url: None
+        FakeBulkHandler.archived = {'1234567890_sdp_l0': {
+            'id': '1234567890_sdp_l0', 'CAS.ProductTypeName': 'MeerKATTelescopeProduct',
+            'CaptureBlockId': '1234567890', 'StreamId': 'sdp_l0', 'CaptureStreamId': '1234567890_sdp_l0',
+            'Prefix': 'old-prefix', 'Targets': ['3C286', 'PKS1934-638'], 'CenterFrequency': 1284.0, '_version_': 1}}
+
+    def tearDown(self):
+        for name, value in self._saved.items():
+            setattr(tel_prod_met_extractor, name, value)
+        shutil.rmtree(self.tmp_dir)
+
+    def _reextract(self, fields):
+        results = [tel_prod_met_extractor.extract_solr_doc(self.katfile, fields)]
+        return list(tel_prod_met_extractor.reextract_results(results, 'http://solr', dry_run=True))
+
+    def test_fields_keep_lookup_keys(self):
+        katfile, prod_met, size, elapsed, message = tel_prod_met_extractor.extract_solr_doc(self.katfile, ['Targets'])
+        self.assertEqual(prod_met['CaptureStreamId'], '1234567890_sdp_l0')
+        self.assertIn('Targets', prod_met)
+        # other fields extracted along with the lookup keys are left out
+        self.assertNotIn('Prefix', prod_met)
+        self.assertNotIn('CenterFrequency', prod_met)
+
+    def test_fields_found_in_archive(self):
+        [(katfile, status, size, elapsed, message)] = self._reextract(['Targets', 'CenterFrequency'])
+        # same targets in another order, and the same frequency as a solr float
+        self.assertEqual((status, message), ('unchanged', ''))
+
+    def test_all_fields(self):
+        [(katfile, status, size, elapsed, message)] = self._reextract(None)
+        self.assertEqual(status, 'updated')
+        self.assertEqual(message, 'Prefix')
+
+    def test_missing(self):
+        FakeBulkHandler.archived = {}
+        [(katfile, status, size, elapsed, message)] = self._reextract(['Targets'])
+        self.assertEqual(status, 'missing')
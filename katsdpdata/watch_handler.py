@@ -0,0 +1,132 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+DEFAULT_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class WatchHandlerException(Exception):
+    """Handle exceptions generated by the watch handler."""
+    pass
+
+
+class InotifyWatcher(object):
+    """Minimal inotify wrapper for watching a tree of product directories.
+    Uses ctypes so that no extra dependencies are needed on the ingest nodes.
+
+    Parameters
+    ----------
+    mask: int : inotify event mask to register for every watched directory.
+    """
+    def __init__(self, mask=DEFAULT_WATCH_MASK):
+        super(InotifyWatcher, self).__init__()
+        self.mask = mask
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise WatchHandlerException('inotify_init1 failed: {}'.format(os.strerror(err)))
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLIN)
+        self._wd_paths = {}
+
+    def add_watch(self, path):
+        """Watch a single directory.
+
+        Parameters
+        ----------
+        path: string : full path to the directory to watch.
+
+        Returns
+        -------
+        wd: int : the inotify watch descriptor, or None if the directory vanished.
+        """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # the directory may have been cleaned up or moved to failed in the meantime
+            if err in (2, 20):  # ENOENT, ENOTDIR
+                return None
+            raise WatchHandlerException('inotify_add_watch on {} failed: {}'.format(path, os.strerror(err)))
+        self._wd_paths[wd] = path
+        return wd
+
+    def add_watch_tree(self, path):
+        """Recursively watch a directory and all of its sub-directories.
+
+        Parameters
+        ----------
+        path: string : full path to the top of the directory tree to watch.
+        """
+        for root, dirnames, filenames in os.walk(path):
+            self.add_watch(root)
+
+    def read_events(self, timeout=None):
+        """Wait for inotify events.
+
+        Parameters
+        ----------
+        timeout: float : seconds to wait for events. Block forever if None.
+
+        Returns
+        -------
+        events: list : a list of (full_path, mask) tuples. An IN_Q_OVERFLOW event
+            is reported with the path set to None.
+        """
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        if not self._poll.poll(timeout):
+            return []
+        try:
+            buf = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, events have been lost.')
+                events.append((None, mask))
+                continue
+            dir_path = self._wd_paths.get(wd)
+            if mask & IN_IGNORED:
+                self._wd_paths.pop(wd, None)
+                continue
+            if dir_path is None:
+                continue
+            if name:
+                events.append((os.path.join(dir_path, os.fsdecode(name)), mask))
+            else:
+                events.append((dir_path, mask))
+        return events
+
+    def close(self):
+        """Close the inotify file descriptor and drop all watches."""
+        if self._fd >= 0:
+            self._poll.unregister(self._fd)
+            os.close(self._fd)
+            self._fd = -1
+            self._wd_paths = {}
@@ -1,21 +1,368 @@
 #!/usr/bin/env python3
 
+"""Extract metadata from telescope products into OODT .met files. Many products
+can be extracted in one run, in parallel on a pool of processes. Archived
+products can also be re-extracted, updating only the changed fields in solr
+with bulk updates."""
+
+import collections
+import concurrent.futures as futures
+import glob
+import multiprocessing
+import os
+import pysolr
 import sys
+import time
 
-from katsdpdata.met_extractors import file_mime_detection
+from katsdpdata.met_extractors import file_mime_detection, metadata_field_names
+from katsdpdata.met_handler import MetaDataBulkHandler, SOLR_BATCH_SIZE, SOLR_COPY_FIELDS
+from katsdpdata.met_handler import diff_prod_met, get_solr, supports_atomic_updates
+from katsdpdata.rdb_handler import read_rdb_keys
 from optparse import OptionParser
 
-usage = 'Usage: %prog katfile'
-parser = OptionParser(usage=usage)
-(options, args) = parser.parse_args()
+# fields that find_prod_met looks up archived products by, extracted with any --fields
+LOOKUP_FIELDS = ['CaptureStreamId', 'CaptureBlockId', 'StreamId']
+
+
+def list_products(args, file_list=None):
+    """List the products to extract, in order and without duplicates.
+
+    Parameters
+    ----------
+    args: list : product file names or glob patterns.
+    file_list: string : file with a product file name per line, '-' for stdin.
+
+    Returns
+    -------
+    products: list : product file names.
+    """
+    products = []
+    for arg in args:
+        matches = sorted(glob.glob(arg))
+        # keep names that don't exist, so that they are reported as failures
+        products.extend(matches if matches else [arg])
+    if file_list:
+        lines = sys.stdin if file_list == '-' else open(file_list)
+        with lines:
+            products.extend(line.strip() for line in lines if line.strip())
+    return list(dict.fromkeys(products))
+
+
+def met_filename(katfile, fmt='xml'):
+    """The metadata file the extractor will write for a product, worked out
+    without opening the product with katdal.
+
+    Parameters
+    ----------
+    katfile: string : name of the product file.
+    fmt: string : 'xml' or 'json'.
+
+    Returns
+    -------
+    met_filename: string : name of the metadata file.
+    """
+    if os.path.splitext(katfile)[1] == '.rdb':
+        attrs = read_rdb_keys(katfile, ['capture_block_id', 'stream_name'])
+        filename = '{}_{}.met'.format(attrs['capture_block_id'], attrs['stream_name'])
+    else:
+        filename = '{}.met'.format(os.path.abspath(katfile))
+    if fmt == 'json':
+        filename = os.path.splitext(filename)[0] + '.json'
+    return filename
+
+
+def fields_filename(met_filename):
+    """The file that field-limited metadata is written to, next to the full
+    metadata file, so that it is never taken for a complete extraction."""
+    root, ext = os.path.splitext(met_filename)
+    return '{}.fields{}'.format(root, ext)
+
+
+def is_extracted(katfile, fmt='xml'):
+    """True if the metadata file exists and is newer than the product."""
+    try:
+        return os.path.getmtime(met_filename(katfile, fmt)) >= os.path.getmtime(katfile)
+    except (OSError, KeyError):
+        return False
+
+
+def extract_product(katfile, fmt='xml', fields=None, force=False):
+    """Extract metadata from a product and write the metadata file.
+
+    Parameters
+    ----------
+    katfile: string : name of the product file.
+    fmt: string : 'xml' or 'json'.
+    fields: list : only extract these metadata fields, and write them to the file
+        named by fields_filename rather than the metadata file. All fields if None.
+    force: boolean : extract even if the metadata file is up to date.
+
+    Returns
+    -------
+    result: tuple : (katfile, status, product size in bytes, seconds taken, message),
+        status being one of 'done', 'skipped' or 'failed'.
+    """
+    start_time = time.time()
+    try:
+        if not force and is_extracted(katfile, fmt):
+            return (katfile, 'skipped', 0, 0.0, '')
+        met_extractor = file_mime_detection(katfile)
+        met_extractor.extract_metadata(fields)
+        if fields is None:
+            met_extractor.write_metadatafile(fmt)
+        else:
+            # as in write_metadatafile, non-ascii characters are written as xml character
+            # references, json escapes them itself
+            with open(fields_filename(met_filename(katfile, fmt)), 'w',
+                      encoding='ascii', errors='xmlcharrefreplace') as metfile:
+                if fmt == 'json':
+                    met_extractor.write_json(metfile)
+                else:
+                    met_extractor.write_xml(metfile)
+    except Exception as err:
+        return (katfile, 'failed', 0, time.time() - start_time, '{}: {}'.format(type(err).__name__, err))
+    return (katfile, 'done', os.path.getsize(katfile), time.time() - start_time, met_extractor.stage_summary())
+
+
+def find_prod_met(solr, archived, katfile, prod_met):
+    """Find the archived solr document of a product. MeerKAT products are
+    archived with their capture stream id, older products are found by their
+    original reference.
+
+    Parameters
+    ----------
+    solr: pysolr.Solr : solr client for the archive.
+    archived: dict : solr documents already looked up by id.
+    katfile: string : name of the product file.
+    prod_met: dict : extracted product metadata.
+
+    Returns
+    -------
+    met: dict : the solr document, None if the product is not in the archive.
+    """
+    if 'CaptureStreamId' in prod_met:
+        return archived.get(prod_met['CaptureStreamId'])
+    res = solr.search('CAS.ReferenceOriginal:"{}"'.format(os.path.abspath(katfile)))
+    return res.docs[0] if res.hits == 1 else None
+
+
+def extract_solr_doc(katfile, fields=None):
+    """Extract metadata from a product as a solr document.
+
+    Parameters
+    ----------
+    katfile: string : name of the product file.
+    fields: list : only extract these metadata fields. All fields if None. The
+        LOOKUP_FIELDS needed to find the archived product are always extracted.
+
+    Returns
+    -------
+    result: tuple : (katfile, solr document, product size in bytes, seconds taken, message),
+        the solr document being None if the extraction failed.
+    """
+    start_time = time.time()
+    try:
+        met_extractor = file_mime_detection(katfile)
+        if fields is None:
+            met_extractor.extract_metadata()
+        else:
+            met_extractor.extract_metadata(list(fields) + LOOKUP_FIELDS)
+        prod_met = met_extractor.solr_doc()
+        if fields is not None:
+            # leave out other fields extracted along with the lookup fields, e.g. Prefix
+            unwanted = set(metadata_field_names()) - set(fields) - set(LOOKUP_FIELDS)
+            prod_met = {k: v for k, v in prod_met.items() if k not in unwanted}
+    except Exception as err:
+        return (katfile, None, 0, time.time() - start_time, '{}: {}'.format(type(err).__name__, err))
+    return (katfile, prod_met, os.path.getsize(katfile), time.time() - start_time, '')
+
+
+def update_archive(extracted, solr_url, dry_run=False):
+    """Update the fields that differ from the archived solr documents for a batch
+    of extracted products, with one lookup and one bulk update for the batch.
+
+    Parameters
+    ----------
+    extracted: list : (katfile, solr document, product size in bytes, seconds taken) tuples.
+    solr_url: string : solr endpoint of the archive.
+    dry_run: boolean : only report the changed fields, don't update solr.
+
+    Returns
+    -------
+    results: list : (katfile, status, product size in bytes, seconds taken, message) tuples,
+        status being one of 'updated', 'unchanged', 'missing' or 'failed'.
+    """
+    bulk = MetaDataBulkHandler(solr_url)
+    solr = get_solr(solr_url)
+    try:
+        archived = bulk.get_prod_mets([prod_met['CaptureStreamId'] for katfile, prod_met, size, elapsed
+                                       in extracted if 'CaptureStreamId' in prod_met])
+    except pysolr.SolrError as err:
+        return [(katfile, 'failed', 0, elapsed, 'SolrError: {}'.format(err))
+                for katfile, prod_met, size, elapsed in extracted]
+    atomic = not dry_run and supports_atomic_updates(solr_url)
+    results = []
+    updates = {}
+    for katfile, prod_met, size, elapsed in extracted:
+        try:
+            met = find_prod_met(solr, archived, katfile, prod_met)
+        except pysolr.SolrError as err:
+            results.append((katfile, 'failed', 0, elapsed, 'SolrError: {}'.format(err)))
+            continue
+        if met is None:
+            results.append((katfile, 'missing', 0, elapsed, 'not found in the archive'))
+            continue
+        changed = diff_prod_met(met, prod_met)
+        message = ', '.join(sorted(changed))
+        if not changed or dry_run:
+            results.append((katfile, 'updated' if changed else 'unchanged', size, elapsed, message))
+        elif atomic:
+            updates[katfile] = dict(changed, id=met['id'])
+            results.append((katfile, 'updated', size, elapsed, message))
+        else:
+            # the whole document, with its _version_ so concurrent changes aren't lost
+            updates[katfile] = {k: v for k, v in dict(met, **changed).items() if k not in SOLR_COPY_FIELDS}
+            results.append((katfile, 'updated', size, elapsed, message))
+    if updates:
+        field_updates = None
+        if atomic:
+            field_updates = {k: 'set' for doc in updates.values() for k in doc if k != 'id'}
+        try:
+            errors = bulk.add_prod_mets(list(updates.values()), field_updates).errors
+        except pysolr.SolrError as err:
+            errors = {doc['id']: 'SolrError: {}'.format(err) for doc in updates.values()}
+        for i, (katfile, status, size, elapsed, message) in enumerate(results):
+            prod_id = updates[katfile]['id'] if katfile in updates else None
+            if prod_id in errors:
+                results[i] = (katfile, 'failed', 0, elapsed, errors[prod_id])
+    return results
+
+
+def reextract_results(results, solr_url, dry_run=False, batch_size=SOLR_BATCH_SIZE):
+    """Update the archive from extract_solr_doc results, batch_size products at a time.
+
+    Parameters
+    ----------
+    results: iterable : extract_solr_doc results.
+    solr_url: string : solr endpoint of the archive.
+    dry_run: boolean : only report the changed fields, don't update solr.
+    batch_size: int : number of products to look up and update in solr at a time.
+
+    Returns
+    -------
+    results: generator : (katfile, status, product size in bytes, seconds taken, message) tuples.
+    """
+    batch = []
+    for katfile, prod_met, size, elapsed, message in results:
+        if prod_met is None:
+            yield (katfile, 'failed', 0, elapsed, message)
+            continue
+        batch.append((katfile, prod_met, size, elapsed))
+        if len(batch) >= batch_size:
+            yield from update_archive(batch, solr_url, dry_run)
+            batch = []
+    if batch:
+        yield from update_archive(batch, solr_url, dry_run)
+
+
+def run_task(task, products, workers, task_args=()):
+    """Run a task on many products, on a pool of processes.
+
+    Parameters
+    ----------
+    task: function : called with each product and task_args, e.g. extract_product.
+    products: list : names of the product files.
+    workers: int : number of worker processes. Run in this process if 1.
+    task_args: tuple : further arguments for the task.
+
+    Returns
+    -------
+    results: generator : the result of the task for each product, as they complete.
+    """
+    if workers > 1:
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            procs = [executor.submit(task, p, *task_args) for p in products]
+            for p in futures.as_completed(procs):
+                yield p.result()
+    else:
+        for p in products:
+            yield task(p, *task_args)
+
+
+def process_products(results, products, verbose=False):
+    """Gather the results for many products, and print a summary.
+
+    Parameters
+    ----------
+    results: iterable : a (katfile, status, size, elapsed, message) tuple per product,
+        e.g. from run_task with extract_product.
+    products: list : names of the product files.
+    verbose: boolean : print a line per product.
+
+    Returns
+    -------
+    failed: list : (katfile, message) for each product that failed.
+    """
+    start_time = time.time()
+    counts = collections.Counter()
+    nbytes = 0
+    failed = []
+    for katfile, status, size, elapsed, message in results:
+        counts[status] += 1
+        nbytes += size
+        if status == 'failed':
+            failed.append((katfile, message))
+        if verbose:
+            print('{} {} in {:.2f} s. {}'.format(status.capitalize(), katfile, elapsed, message))
+    elapsed = time.time() - start_time
+    processed = sum(n for status, n in counts.items() if status not in ('skipped', 'failed'))
+    print('{} products in {:.1f} s: {}. {:.2f} products/s, {:.1f} MB/s.'.format(
+        len(products), elapsed, ', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items())),
+        processed / max(elapsed, 1e-6), nbytes / 1e6 / max(elapsed, 1e-6)))
+    for katfile, message in failed:
+        print('  {}: {}'.format(katfile, message))
+    return failed
+
 
-if (len(sys.argv) == 2):
-    filename = sys.argv[1]
-else:
-    print(parser.format_help())
-    sys.exit(0)
+if __name__ == '__main__':
+    usage = 'Usage: %prog [options] katfile [katfile ...]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('--file-list',
+                      help="File with a product name per line, '-' to read the names from stdin")
+    parser.add_option('--workers', type='int', default=1,
+                      help='Number of products to extract in parallel, 0 for one per CPU [default = %default]')
+    parser.add_option('--format', type='choice', choices=['xml', 'json'], default='xml',
+                      help='Write OODT xml .met files or json solr documents [default = %default]')
+    parser.add_option('--fields',
+                      help='Comma separated list of the metadata fields to extract, written to a separate '
+                           '.fields.met or .fields.json file. Needs --force or --solr-url [default = all fields]')
+    parser.add_option('--force', action='store_true', default=False,
+                      help='Extract products even if their metadata file is up to date')
+    parser.add_option('--solr-url',
+                      help='Re-extract archived products and update the fields that changed in this solr core')
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help='With --solr-url, only report the fields that changed')
+    parser.add_option('--verbose', action='store_true', default=False,
+                      help='Print a line for every product')
+    (options, args) = parser.parse_args()
 
-# met extractor specific
-met_extractor = file_mime_detection(filename)
-met_extractor.extract_metadata()
-met_extractor.write_metadatafile()
+    if options.fields and not (options.force or options.solr_url):
+        parser.error('--fields needs --force, or --solr-url to update the archive')
+    fields = options.fields.split(',') if options.fields else None
+    if fields:
+        unknown = [f for f in fields if f not in metadata_field_names()]
+        if unknown:
+            parser.error('Unknown --fields {}. Valid fields are: {}'.format(
+                ', '.join(unknown), ', '.join(metadata_field_names())))
+    products = list_products(args, options.file_list)
+    if not products:
+        print(parser.format_help())
+        sys.exit(0)
+    workers = min(options.workers if options.workers > 0 else multiprocessing.cpu_count(), len(products))
+    if options.solr_url:
+        results = reextract_results(run_task(extract_solr_doc, products, workers, (fields,)),
+                                    options.solr_url, options.dry_run)
+    else:
+        results = run_task(extract_product, products, workers, (options.format, fields, options.force))
+    failed = process_products(results, products, options.verbose)
+    sys.exit(1 if failed else 0)
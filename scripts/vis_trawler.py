@@ -2,8 +2,11 @@
 
 """Parallel file uploader to trawl NPY files into S3."""
 
+import asyncio
+import collections
 import boto
 import boto.s3.connection
+import boto.s3.multipart
 import concurrent.futures as futures
 import json
 import katsdpservices
@@ -11,28 +14,62 @@ import logging
 import multiprocessing
 import os
 import pysolr
+import queue
 import re
 import sys
 import socket
 import shutil
+import threading
 import time
 
+from concurrent.futures.process import BrokenProcessPool
 from katsdpdata.met_detectors import file_type_detection
 from katsdpdata.met_extractors import MetExtractorException
-from katsdpdata.met_handler import MetaDataHandler
+from katsdpdata.met_handler import MetaDataHandler, SOLR_CLIENT_ERROR, get_solr
+from katsdpdata.watch_handler import InotifyWatcher, WatchHandlerException
+from katsdpdata.watch_handler import IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, IN_MOVED_TO
+from katsdpdata.prod_handler import UploadController
 from katsdpdata.prod_handler import get_s3_connection
+from katsdpdata.prod_handler import is_transient_upload_error
 from katsdpdata.prod_handler import make_boto_dict
 from katsdpdata.prod_handler import redact_key
+from katsdpdata.scan_handler import ScanIndex
+from katsdpdata.spool_handler import MetaDataSpool, SpoolReplayer
 from optparse import OptionParser
 
 CAPTURE_BLOCK_REGEX = "^[0-9]{10}$"
 CAPTURE_STREAM_REGEX = "^[0-9]{10}[-_].*$"
 MAX_TRANSFERS = 5000
 CPU_MULTIPLIER = 10
+BATCHES_PER_WORKER = 4
 SLEEP_TIME = 20
+WATCH_RESCAN_TIME = 600
+WATCH_BATCH_TIME = 1
+WATCH_MAX_BATCH_AGE = 10
+PIPELINE_QUEUE_SIZE = 2
+INGEST_CONCURRENCY = 4
+MULTIPART_THRESHOLD = 256 * 1e6
+MULTIPART_CHUNK_SIZE = 64 * 2**20
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_WORKERS = 8
+MULTIPART_RETRIES = 3
 
+UPLOAD_ENGINE = 'process'
+UPLOAD_CONCURRENCY = 256
+UPLOAD_RETRIES = 3
+MAX_UPLOAD_RATE = None
 
-def main(trawl_dir, boto_dict, solr_url):
+# local spool for metadata writes while solr is unavailable, None to write to solr directly
+metadata_spool = None
+
+# per worker state for uploads, one worker per process or per asyncio engine thread
+_worker_state = threading.local()
+_async_upload_executor = None
+_upload_controller = None
+_async_upload_lock = threading.Lock()
+
+
+def main(trawl_dir, boto_dict, solr_url, watch=False, pipeline=False):
     """Main loop for python script. Trawl directory and ingest products into
     archive.  Loop forever, catch any exceptions and continue.
 
@@ -41,27 +78,47 @@ def main(trawl_dir, boto_dict, solr_url):
     trawl_dir: string : Full path to directory to trawl for products.
     boto_dict: dict : A boto configuration dict.
     sorl_url: string : A solr end point for metadata handeling.
+    watch: boolean : React to inotify events rather than polling the trawl directory.
+    pipeline: boolean : Overlap scanning, capture block ingest and uploads.
     """
     # test s3 connection
     s3_conn = get_s3_connection(boto_dict)
     s3_conn.close()
+    watcher = make_watcher(trawl_dir) if watch else None
+    # keep track of directory listings between trawls
+    scan_index = ScanIndex()
+    # upload workers and their s3 connections live for the life of the trawler
+    upload_pool = make_upload_pool(upload_worker_count()) if UPLOAD_ENGINE == 'process' else None
 
     # Outer loop: Trawl forever. Catch all exceptions.
     # Inner loop: Test S3 forever. Catch S3Response error or socket error.
     #            Break back to outer loop on success.
     while True:
         try:
-            ret = trawl(trawl_dir, boto_dict, solr_url)
-            if ret == 0:
-                # if we did not upload anything, probably a good idea to sleep for SLEEP_TIME
-                time.sleep(SLEEP_TIME)
-        except (socket.error, boto.exception.S3ResponseError, pysolr.SolrError):
+            if watcher:
+                # loops forever, only exits on an exception
+                watch_trawl(watcher, trawl_dir, boto_dict, solr_url, scan_index, upload_pool)
+            elif pipeline:
+                # loops forever, only exits on an exception
+                pipeline_trawl(trawl_dir, boto_dict, solr_url, scan_index, upload_pool)
+            else:
+                ret = trawl(trawl_dir, boto_dict, solr_url, scan_index, upload_pool)
+                if ret == 0:
+                    # if we did not upload anything, probably a good idea to sleep for SLEEP_TIME
+                    time.sleep(SLEEP_TIME)
+        except (socket.error, boto.exception.S3ResponseError, pysolr.SolrError, BrokenProcessPool):
             logger.error("Exception thrown while trawling. Test solr and s3 connection before continuing.")
+            # start again with fresh upload workers and connections
+            if upload_pool:
+                upload_pool.shutdown(wait=False)
+                upload_pool = make_upload_pool(upload_worker_count())
             while True:
                 try:
                     s3_conn = get_s3_connection(boto_dict)
-                    solr_conn = pysolr.Solr(solr_url)
-                    solr_conn.search('*:*')
+                    # metadata is spooled while solr is down, so only wait for s3
+                    if metadata_spool is None:
+                        solr_conn = get_solr(solr_url)
+                        solr_conn.search('*:*')
                 except Exception as e:
                     logger.debug('Caught exception.')
                     logger.debug('Exception: %s', str(e))
@@ -71,12 +128,44 @@ def main(trawl_dir, boto_dict, solr_url):
                     s3_conn.close()
                     break
             continue
+        except WatchHandlerException:
+            # e.g. the kernel limit on inotify watches has been reached
+            logger.exception("Unable to watch trawl directory. Falling back to polling every %i s.", SLEEP_TIME)
+            watcher.close()
+            watcher = None
+            continue
         except Exception:
             logger.exception("Exception thrown while trawling.")
             break
+    if upload_pool:
+        upload_pool.shutdown(wait=True)
+
+
+def make_watcher(trawl_dir):
+    """Watch the trawl directory tree with inotify.
+
+    Parameters
+    ----------
+    trawl_dir: string : Full path to directory to trawl for products.
+
+    Returns
+    -------
+    watcher: InotifyWatcher : watcher with the trawl directory tree added, or None
+        if the tree can't be watched and the trawler should poll instead.
+    """
+    watcher = None
+    try:
+        watcher = InotifyWatcher()
+        watcher.add_watch_tree(trawl_dir)
+    except WatchHandlerException:
+        logger.exception("Unable to watch trawl directory. Falling back to polling every %i s.", SLEEP_TIME)
+        if watcher:
+            watcher.close()
+        return None
+    return watcher
 
 
-def trawl(trawl_dir, boto_dict, solr_url):
+def trawl(trawl_dir, boto_dict, solr_url, scan_index=None, upload_pool=None):
     """Main action for trawling a directory for ingesting products
     into the archive.
 
@@ -85,6 +174,8 @@ def trawl(trawl_dir, boto_dict, solr_url):
     trawl_dir: string : Full path to directory to trawl for products.
     boto_dict: dict : A boto configuration dict.
     sorl_url: string : A solr end point for metadata handeling.
+    scan_index: ScanIndex : Optional index to reuse directory listings from previous trawls.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
 
     Return
     ------
@@ -92,75 +183,420 @@ def trawl(trawl_dir, boto_dict, solr_url):
         wait for a set time before trawling directory again.
     """
     cb_dirs, cs_dirs = list_trawl_dir(trawl_dir)
-    # prune cb_dirs
-    # this is tested by checking if there are any cs_dirs that start with the cb.
-    # cb's will only be transferred once all their streams have their
-    # complete token set.
-    for cb in cb_dirs[:]:
-        for cs in cs_dirs:
-            if cs.startswith(cb):
-                cb_dirs.remove(cb)
-                break
     # transfer any cb_dirs that have complete streams
-    for cb in sorted(cb_dirs):
+    capture_blocks = []
+    for cb in sorted(prune_capture_block_dirs(cb_dirs, cs_dirs)):
         # check for conditions
-        cb_files, complete = list_trawl_files(cb, '*.rdb', '*.writing.rdb', 'complete')
+        cb_files, complete = list_trawl_files(cb, '*.rdb', '*.writing.rdb', 'complete', scan_index=scan_index)
         if complete and len(cb_files) == 0:
-            cleanup(cb)
+            cleanup(cb, scan_index)
         elif len(cb_files) >= 1:
-            # find all unique products
-            rdb_prods = list(set([re.match('^.*[0-9]{10}_[^.]*', cbf).group()
-                             for cbf in cb_files
-                             if re.match('^.*[0-9]{10}_[^.]*', cbf) is not None]))
-            # keep track of when a product failes to ingest. Break out of the loop at the first
-            # failure so that the directory is listed again and the failed token is detected.
-            # TODO: turn this into a function so that we can return rather than use a failed_ingest
-            #       token.
-            failed_ingest = False
-            # list the rdb prods in order, so that if l0 is broken
-            # product directory is marked as failed and no further streams are transferred.
-            for rdb_prod in sorted(rdb_prods):
-                rdb_lite, rdb_full = rdb_prod + '.rdb', rdb_prod + '.full.rdb'
-                if rdb_lite in cb_files and rdb_full in cb_files:
-                    try:
-                        try:
-                            prod_met_extractor = file_type_detection(rdb_lite)
-                        except Exception as err:
-                            bucket_name = os.path.relpath(rdb_lite, trawl_dir).split("/", 1)[0]
-                            err.bucket_name = bucket_name
-                            err.filename = rdb_lite
-                            raise
-                        met = ingest_vis_product(trawl_dir, os.path.relpath(rdb_prod, cb),
-                                                 [rdb_lite, rdb_full], prod_met_extractor, solr_url)
-                        logger.info('%s ingested into archive with datastore refs:%s.' %
-                                    (met['id'], ', '.join(met['CAS.ReferenceDatastore'])))
-                    except Exception as err:
-                        if hasattr(err, 'bucket_name'):
-                            logger.exception("Caught exception while extracting metadata from %s.", err.filename)
-                            set_failed_token(os.path.join(trawl_dir, err.bucket_name), str(err))
-                            # if failed, set a boolean flag to exit the loop.
-                            failed_ingest = True
-                        else:
-                            raise
-                # if the rdb_prod failed, don't continue to the next stream product
-                if failed_ingest:
-                    break
+            capture_blocks.append((cb, cb_files))
+    ingest_capture_blocks(trawl_dir, capture_blocks, solr_url, upload_pool)
     upload_list = []
     for cs in sorted(cs_dirs):
         # check for condtions
-        cs_files, complete = list_trawl_files(cs, '*.npy', '*.writing.npy', 'complete')
+        cs_files, complete = list_trawl_files(cs, '*.npy', '*.writing.npy', 'complete', scan_index=scan_index)
         if complete and len(cs_files) == 0:
-            cleanup(cs)
+            cleanup(cs, scan_index)
         elif len(cs_files) >= 1:
             upload_list.extend(cs_files)
+    log_scan_progress(scan_index)
 
     # batch upload numpy files
-    upload_list = upload_list[0:MAX_TRANSFERS]
-    upload_size = sum(os.path.getsize(f)
-                      for f in upload_list if os.path.isfile(f))
+    return upload_files(trawl_dir, boto_dict, upload_list[0:MAX_TRANSFERS], upload_pool)
+
+
+def log_scan_progress(scan_index=None):
+    """Log how far behind the last scan of the trawl directory is, if the
+    scan index has directories still to list.
+
+    Parameters
+    ----------
+    scan_index: ScanIndex : Optional index of the directory listings.
+    """
+    if scan_index:
+        progress = scan_index.progress()
+        if progress.pending:
+            logger.info("Trawl is behind: %i of %i directories still to list.",
+                        progress.pending, progress.visited + progress.pending)
+
+
+def prune_capture_block_dirs(cb_dirs, cs_dirs):
+    """Prune capture block directories that still have capture stream directories.
+    This is tested by checking if there are any cs_dirs that start with the cb.
+    cb's will only be transferred once all their streams have their
+    complete token set.
+
+    Parameters
+    ----------
+    cb_dirs: list : full path to capture block directories.
+    cs_dirs: list : full path to capture stream directories.
+
+    Returns
+    -------
+    cb_dirs: list : full path to capture block directories that are ready to ingest.
+    """
+    return [cb for cb in cb_dirs if not any(cs.startswith(cb) for cs in cs_dirs)]
+
+
+def ingest_capture_blocks(trawl_dir, capture_blocks, solr_url, upload_pool=None):
+    """Ingest capture blocks concurrently, up to INGEST_CONCURRENCY at a time.
+    A product that fails to ingest only sets the failed token on its own
+    bucket directory. Other exceptions don't interrupt the remaining
+    capture blocks, the first one is raised once they have all finished.
+    Capture blocks that can't be ingested while solr is unavailable, see
+    is_deferred_ingest, are left for the next trawl.
+
+    Parameters
+    ----------
+    trawl_dir: string : Full path to directory to trawl for products.
+    capture_blocks: list : (capture block directory, rdb files) tuples to ingest.
+    sorl_url: string : A solr end point for metadata handeling.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
+    """
+    if not capture_blocks:
+        return
+    workers = min(len(capture_blocks), INGEST_CONCURRENCY)
+    with futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest') as executor:
+        procs = [(cb, executor.submit(ingest_capture_block, trawl_dir, cb, cb_files, solr_url, upload_pool))
+                 for cb, cb_files in capture_blocks]
+    errors = []
+    for cb, p in procs:
+        try:
+            p.result()
+        except Exception as err:
+            if is_deferred_ingest(err):
+                logger.warning("Solr unavailable, leaving %s for the next trawl: %s", cb, err)
+                continue
+            logger.error("Exception thrown while ingesting %s: %s", cb, err)
+            errors.append(err)
+    if errors:
+        raise errors[0]
+
+
+def is_deferred_ingest(err):
+    """Test if a capture block ingest failed only because solr is unavailable,
+    while metadata writes are being spooled. The capture block is then left in
+    place to be ingested once solr is back, rather than holding up the uploads
+    of capture stream files, which don't need solr.
+
+    Parameters
+    ----------
+    err: Exception : the exception raised by the ingest.
+
+    Returns
+    -------
+    deferred: boolean : True if the ingest should be tried again later.
+    """
+    return (metadata_spool is not None and isinstance(err, pysolr.SolrError) and
+            not SOLR_CLIENT_ERROR.search(str(err)))
+
+
+def ingest_capture_block(trawl_dir, cb, cb_files, solr_url, upload_pool=None):
+    """Ingest the rdb products in a capture block directory. Stop at the first
+    product that fails to ingest, after setting the failed token, so that the
+    directory is listed again and the failed token is detected.
+
+    Parameters
+    ----------
+    trawl_dir: string : Full path to directory to trawl for products.
+    cb: string : Full path to the capture block directory.
+    cb_files: list : Full path to the rdb files in the capture block directory.
+    sorl_url: string : A solr end point for metadata handeling.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
+    """
+    # find all unique products
+    rdb_prods = list(set([re.match('^.*[0-9]{10}_[^.]*', cbf).group()
+                     for cbf in cb_files
+                     if re.match('^.*[0-9]{10}_[^.]*', cbf) is not None]))
+    # list the rdb prods in order, so that if l0 is broken
+    # product directory is marked as failed and no further streams are transferred.
+    for rdb_prod in sorted(rdb_prods):
+        rdb_lite, rdb_full = rdb_prod + '.rdb', rdb_prod + '.full.rdb'
+        if rdb_lite in cb_files and rdb_full in cb_files:
+            try:
+                try:
+                    pm_extractor = file_type_detection(rdb_lite)
+                except Exception as err:
+                    bucket_name = os.path.relpath(rdb_lite, trawl_dir).split("/", 1)[0]
+                    err.bucket_name = bucket_name
+                    err.filename = rdb_lite
+                    raise
+                met = ingest_vis_product(trawl_dir, os.path.relpath(rdb_prod, cb),
+                                         [rdb_lite, rdb_full], pm_extractor, solr_url,
+                                         upload_pool)
+                logger.info('%s ingested into archive with datastore refs:%s.' %
+                            (met['id'], ', '.join(met['CAS.ReferenceDatastore'])))
+            except Exception as err:
+                if hasattr(err, 'bucket_name'):
+                    logger.exception("Caught exception while extracting metadata from %s.", err.filename)
+                    set_failed_token(os.path.join(trawl_dir, err.bucket_name), str(err))
+                    # if the rdb_prod failed, don't continue to the next stream product
+                    return
+                else:
+                    raise
+
+
+def watch_trawl(watcher, trawl_dir, boto_dict, solr_url, scan_index=None, upload_pool=None):
+    """Event driven alternative to polling with trawl. Completed capture stream
+    files are queued for upload as soon as they are renamed into place.
+    New rdb products and complete/failed tokens trigger a full trawl, as does
+    WATCH_RESCAN_TIME passing, which acts as a safety net for missed events.
+    Queued files are uploaded once events stop arriving, MAX_TRANSFERS files are
+    queued, or the oldest queued file has waited WATCH_MAX_BATCH_AGE seconds.
+    Loop forever, exceptions are left for the caller to handle.
+
+    Parameters
+    ----------
+    watcher: InotifyWatcher : watcher with the trawl directory tree added.
+    trawl_dir: string : Full path to directory to trawl for products.
+    boto_dict: dict : A boto configuration dict.
+    sorl_url: string : A solr end point for metadata handeling.
+    scan_index: ScanIndex : Optional index to reuse directory listings from previous trawls.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
+    """
+    upload_list = []
+    queued_since = None
+    rescan = True
+    last_scan = 0
+    while True:
+        if rescan or time.time() - last_scan > WATCH_RESCAN_TIME:
+            # the full trawl picks up anything already queued
+            upload_list = []
+            queued_since = None
+            trawl(trawl_dir, boto_dict, solr_url, scan_index, upload_pool)
+            last_scan = time.time()
+            rescan = False
+        # wait a short while for more events if there is something to upload
+        timeout = WATCH_BATCH_TIME if upload_list else SLEEP_TIME
+        events = watcher.read_events(timeout)
+        for path, mask in events:
+            if path is None:
+                # event queue overflowed
+                rescan = True
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    watcher.add_watch_tree(path)
+                    # files may have landed before the watch was added
+                    for root, dirnames, filenames in os.walk(path):
+                        upload_list.extend(os.path.join(root, f) for f in filenames
+                                           if is_watched_upload(trawl_dir, os.path.join(root, f)))
+                continue
+            filename = os.path.basename(path)
+            if filename in ('complete', 'failed') or (filename.endswith('.rdb') and
+                                                      not filename.endswith('.writing.rdb')):
+                rescan = True
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_watched_upload(trawl_dir, path):
+                # only once the file has been written, IN_CREATE is only used to watch new directories
+                upload_list.append(path)
+        if not upload_list:
+            continue
+        if queued_since is None:
+            queued_since = time.time()
+        # don't let a steady stream of events hold back the upload
+        if (not events or len(upload_list) >= MAX_TRANSFERS or
+                time.time() - queued_since >= WATCH_MAX_BATCH_AGE):
+            upload_files(trawl_dir, boto_dict, upload_list[0:MAX_TRANSFERS], upload_pool)
+            upload_list = upload_list[MAX_TRANSFERS:]
+            queued_since = time.time() if upload_list else None
+
+
+def is_watched_upload(trawl_dir, filename):
+    """Test if a file reported by the watcher is a completed capture stream file.
+
+    Parameters
+    ----------
+    trawl_dir: string : Full path to the trawl directory.
+    filename: string : Full path to the file.
+
+    Returns
+    -------
+    boolean : True if the file should be uploaded.
+    """
+    if not filename.endswith('.npy') or filename.endswith('.writing.npy'):
+        return False
+    bucket_name = os.path.relpath(filename, trawl_dir).split("/", 1)[0]
+    return re.match(CAPTURE_STREAM_REGEX, bucket_name) is not None
+
+
+def pipeline_trawl(trawl_dir, boto_dict, solr_url, scan_index=None, upload_pool=None):
+    """Pipelined alternative to trawl. Scanning runs in this thread, while
+    capture block ingest and capture stream uploads each run in their own
+    stage thread, fed through bounded queues. Up to INGEST_CONCURRENCY
+    capture blocks are ingested at a time. A slow metadata ingest no longer
+    holds up chunk uploads, and the trawl directory is scanned again while
+    uploads are in flight. Files and directories already in the pipeline are
+    skipped by the scan, and a directory with uploads in flight is not moved
+    to the failed directory or deleted until they have finished. Capture blocks
+    that can't be ingested while solr is unavailable, see is_deferred_ingest,
+    are tried again after SLEEP_TIME. Loop forever, the first exception from
+    any stage is raised for the caller to handle.
+
+    Parameters
+    ----------
+    trawl_dir: string : Full path to directory to trawl for products.
+    boto_dict: dict : A boto configuration dict.
+    sorl_url: string : A solr end point for metadata handeling.
+    scan_index: ScanIndex : Optional index to reuse directory listings from previous trawls.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
+    """
+    ingest_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upload_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # capture block directories and capture stream files queued or being processed
+    in_flight = set()
+    # capture blocks left until solr is available again, with the time they were deferred
+    deferred = {}
+    # number of queued or uploading files in each capture stream directory
+    busy_buckets = collections.Counter()
+    in_flight_lock = threading.Lock()
+    errors = queue.Queue()
+    stop = threading.Event()
+
+    def ingest_stage():
+        while not stop.is_set():
+            try:
+                cb, cb_files = ingest_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                ingest_capture_block(trawl_dir, cb, cb_files, solr_url, upload_pool)
+            except Exception as err:
+                if is_deferred_ingest(err):
+                    logger.warning("Solr unavailable, leaving %s for %i s: %s", cb, SLEEP_TIME, err)
+                    with in_flight_lock:
+                        deferred[cb] = time.time()
+                else:
+                    errors.put(err)
+                    stop.set()
+            finally:
+                with in_flight_lock:
+                    in_flight.discard(cb)
+
+    def upload_stage():
+        while not stop.is_set():
+            try:
+                upload_list = upload_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                upload_files(trawl_dir, boto_dict, upload_list, upload_pool)
+            except Exception as err:
+                errors.put(err)
+                stop.set()
+            finally:
+                with in_flight_lock:
+                    in_flight.difference_update(upload_list)
+                    busy_buckets.subtract(upload_bucket(f) for f in upload_list)
+                    for bucket in [b for b, n in busy_buckets.items() if n <= 0]:
+                        del busy_buckets[bucket]
+
+    def upload_bucket(filename):
+        return os.path.relpath(filename, trawl_dir).split("/", 1)[0]
+
+    stages = [threading.Thread(target=ingest_stage, name='ingest-%i' % i, daemon=True)
+              for i in range(INGEST_CONCURRENCY)]
+    stages.append(threading.Thread(target=upload_stage, name='upload', daemon=True))
+    for stage in stages:
+        stage.start()
+    try:
+        while not stop.is_set():
+            queued = 0
+            cb_dirs, cs_dirs = list_trawl_dir(trawl_dir)
+            for cb in sorted(prune_capture_block_dirs(cb_dirs, cs_dirs)):
+                with in_flight_lock:
+                    if cb in in_flight or time.time() - deferred.get(cb, 0) < SLEEP_TIME:
+                        continue
+                    deferred.pop(cb, None)
+                cb_files, complete = list_trawl_files(cb, '*.rdb', '*.writing.rdb', 'complete',
+                                                      scan_index=scan_index)
+                if complete and len(cb_files) == 0:
+                    cleanup(cb, scan_index)
+                elif len(cb_files) >= 1:
+                    with in_flight_lock:
+                        in_flight.add(cb)
+                    if not put_pipeline_item(ingest_queue, (cb, cb_files), stop):
+                        break
+                    queued += 1
+            upload_list = []
+            for cs in sorted(cs_dirs):
+                with in_flight_lock:
+                    busy = busy_buckets[os.path.basename(cs)] > 0
+                if busy and os.path.isfile(os.path.join(cs, "failed")):
+                    # move it to the failed directory once its uploads have finished
+                    continue
+                cs_files, complete = list_trawl_files(cs, '*.npy', '*.writing.npy', 'complete',
+                                                      scan_index=scan_index)
+                if complete and len(cs_files) == 0:
+                    if not busy:
+                        cleanup(cs, scan_index)
+                elif len(cs_files) >= 1:
+                    with in_flight_lock:
+                        upload_list.extend(f for f in cs_files if f not in in_flight)
+            log_scan_progress(scan_index)
+            for i in range(0, len(upload_list), MAX_TRANSFERS):
+                batch = upload_list[i:i + MAX_TRANSFERS]
+                with in_flight_lock:
+                    in_flight.update(batch)
+                    busy_buckets.update(upload_bucket(f) for f in batch)
+                if not put_pipeline_item(upload_queue, batch, stop):
+                    break
+                queued += 1
+            if queued == 0:
+                # nothing new to do, probably a good idea to sleep for SLEEP_TIME
+                stop.wait(SLEEP_TIME)
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+    raise errors.get()
+
+
+def put_pipeline_item(work_queue, item, stop):
+    """Put an item onto a bounded pipeline queue, blocking while the queue
+    is full, unless the pipeline is stopped.
+
+    Parameters
+    ----------
+    work_queue: queue.Queue : the queue feeding a pipeline stage.
+    item: object : the work item.
+    stop: threading.Event : set when the pipeline is stopping.
+
+    Returns
+    -------
+    boolean : True if the item was queued.
+    """
+    while not stop.is_set():
+        try:
+            work_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def upload_files(trawl_dir, boto_dict, upload_list, upload_pool=None):
+    """Upload a batch of capture stream files and set the failed token on
+    any bucket directories that failed to upload.
+
+    Parameters
+    ----------
+    trawl_dir: string : Full path to the trawl directory.
+    boto_dict: dict : A boto configuration dict.
+    upload_list: list : A list of full path to files to upload.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
+
+    Returns
+    -------
+    upload_size: int : The size in bytes of data uploaded.
+    """
+    # files may have been uploaded or removed since they were listed
+    upload_list = [f for f in dict.fromkeys(upload_list) if os.path.isfile(f)]
+    upload_size = sum(os.path.getsize(f) for f in upload_list)
     if upload_size > 0:
         logger.debug("Uploading %.2f MB of data", (upload_size // 1e6))
-        proc_results = parallel_upload(trawl_dir, boto_dict, upload_list)
+        proc_results = parallel_upload(trawl_dir, boto_dict, upload_list, upload_pool)
         for pr in proc_results:
             try:
                 res = pr.result()
@@ -169,6 +605,8 @@ def trawl(trawl_dir, boto_dict, solr_url):
                 # test s3 problems, else mark as borken
                 if hasattr(err, 'bucket_name'):
                     set_failed_token(os.path.join(trawl_dir, err.bucket_name), str(err))
+                else:
+                    logger.error("Upload failed (%s). Files not uploaded are retried on the next trawl.", err)
     else:
         logger.debug("No data to upload (%.2f MB)", (upload_size // 1e6))
     return upload_size
@@ -191,14 +629,16 @@ def set_failed_token(prod_dir, msg=None):
             failed_token.write(msg)
 
 
-def cleanup(dir_name):
+def cleanup(dir_name, scan_index=None):
     """Recursive delete the supplied directory supplied directory.
-    Should be a completed product."""
+    Should be a completed product. Also drop it from the scan index, if given."""
     logger.info("%s is complete. Deleting directory tree.", dir_name)
+    if scan_index:
+        scan_index.forget(os.path.abspath(dir_name))
     return shutil.rmtree(dir_name)
 
 
-def ingest_vis_product(trawl_dir, prod_id, original_refs, prod_met_extractor, solr_url):
+def ingest_vis_product(trawl_dir, prod_id, original_refs, pm_extractor, solr_url, upload_pool=None):
     """Ingest a product into the archive. This includes extracting and uploading
     metadata and then moving the product into the archive.
 
@@ -207,40 +647,41 @@ def ingest_vis_product(trawl_dir, prod_id, original_refs, prod_met_extractor, so
     trawl_dir: string : full path to directory to trawl for ingest product.
     prod_id: string : unique id for the product.
     original_refs : list : list of product file(s).
-    product_met_extractor: class : a metadata extractor class.
+    pm_extractor: MetExtractor : a metadata extractor bound to the product.
     solr_url: string : sorl endpoint for metadata queries and upload.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers.
 
     Returns
     -------
     met : dict : a metadata dictionary with uploaded key:value pairs.
     """
     try:
-        pm_extractor = prod_met_extractor(original_refs[0])
         pm_extractor.extract_metadata()
     except Exception as err:
         bucket_name = os.path.relpath(original_refs[0], trawl_dir).split("/", 1)[0]
         err.bucket_name = bucket_name
         err.filename = original_refs[0]
         raise
+    finally:
+        logger.info('Metadata extraction stages for %s: %s.', prod_id, pm_extractor.stage_summary())
     # product metadata extraction
-    mh = MetaDataHandler(solr_url, pm_extractor.product_type, prod_id, prod_id)
-    if not mh.get_prod_met(prod_id):
-        met = mh.create_core_met()
-    else:
-        met = mh.get_prod_met(prod_id)
-    if "CAS.ProductTransferStatus" in met and met["CAS.ProductTransferStatus"] == "RECEIVED":
+    mh = MetaDataHandler(solr_url, pm_extractor.product_type, prod_id, prod_id, spool=metadata_spool)
+    met = mh.get_prod_met(prod_id)
+    if met and "CAS.ProductTransferStatus" in met and met["CAS.ProductTransferStatus"] == "RECEIVED":
         err = MetExtractorException(
             "%s marked as RECEIVED, while trying to create new product.", prod_id)
         err.bucket_name = os.path.relpath(original_refs[0], trawl_dir).split("/", 1)[0]
         raise err
-    # set metadata
-    met = mh.set_product_transferring(met)
+    # set metadata, creating the product if it doesn't exist yet, in a single solr update
     # prepend the most common path to conform to hierarchical products
     met_original_refs = list(original_refs)
     met_original_refs.insert(0, os.path.dirname(os.path.commonprefix(original_refs)))
-    met = mh.add_ref_original(met, met_original_refs)
-    met = mh.add_prod_met(met, pm_extractor.metadata)
-    procs = parallel_upload(trawl_dir, boto_dict, original_refs)
+    met = (mh.begin(met)
+           .set_product_transferring()
+           .add_ref_original(met_original_refs)
+           .add_prod_met(pm_extractor.solr_doc())
+           .commit())
+    procs = parallel_upload(trawl_dir, boto_dict, original_refs, upload_pool)
     transfer_list = []
     for p in procs:
         for r in p.result():
@@ -248,8 +689,7 @@ def ingest_vis_product(trawl_dir, prod_id, original_refs, prod_met_extractor, so
     # prepend the most common path to conform to hierarchical products
     met_transfer_refs = list(transfer_list)
     met_transfer_refs.insert(0, os.path.dirname(os.path.commonprefix(transfer_list)))
-    met = mh.add_ref_datastore(met, met_transfer_refs)
-    met = mh.set_product_received(met)
+    met = mh.begin(met).add_ref_datastore(met_transfer_refs).set_product_received().commit()
     return met
 
 
@@ -279,10 +719,11 @@ def list_trawl_dir(trawl_dir):
     return (capture_block_dirs, capture_stream_dirs,)
 
 
-def list_trawl_files(prod_dir, file_match, file_writing, complete_token, time_out=10):
+def list_trawl_files(prod_dir, file_match, file_writing, complete_token, time_out=10, scan_index=None):
     """Return a list of all trawled files in a directory. Files need to
-    match the glob pattern. Also, add the complete token if found. Timeout
-    after a while, we're going to trim the upload list anyway.
+    match the glob pattern. Also, add the complete token if found. Stop
+    listing after time_out seconds. With a scan index, the next call
+    resumes from the directories that were not listed.
 
     Move products with a failed token into the failed directory.
 
@@ -295,12 +736,16 @@ def list_trawl_files(prod_dir, file_match, file_writing, complete_token, time_ou
                           E.g. '*.writing.npy' or '*.writing.rdb'
     complete_token: string : The complete stream complete token to look
         for in the trawled dir.
+    time_out: float : Seconds to spend listing directories.
+    scan_index: ScanIndex : Optional index of previous listings. Only directories
+        that have changed since the last trawl are listed again.
 
     Returns
     -------
     file_matches: list : A list of all the matching files for the file glob
         and complete token.
-    complete: boolean : True if complete token detected.
+    complete: boolean : True if complete token detected and the whole
+        directory tree was listed.
     """
     prod_dir = os.path.abspath(prod_dir)
     start_time = time.time()
@@ -316,7 +761,11 @@ def list_trawl_files(prod_dir, file_match, file_writing, complete_token, time_ou
         if not os.path.isdir(failed_dir):
             os.mkdir(failed_dir)
         shutil.move(prod_dir, failed_dir)
+        if scan_index:
+            scan_index.forget(prod_dir)
         return ([], False)
+    if scan_index:
+        return scan_index.scan(prod_dir, file_ext, write_ext, complete_token, time_out)
     for root, dirnames, filenames in os.walk(prod_dir):
         for filename in filenames:
             if filename.endswith(write_ext):
@@ -330,6 +779,10 @@ def list_trawl_files(prod_dir, file_match, file_writing, complete_token, time_ou
                 continue
         time_check = time.time() - start_time
         if time_check > time_out:
+            logger.warning("Listing %s timed out after %.1f s. Only %i files found.",
+                           prod_dir, time_check, len(file_matches))
+            # the tree was not fully listed, so the product can't be complete yet
+            complete = False
             break
     return (file_matches, complete,)
 
@@ -347,43 +800,377 @@ def transfer_files(trawl_dir, boto_dict, file_list):
     -------
     transfer_list: list : a list of s3 URLs that where transfered.
     """
-    s3_conn = get_s3_connection(boto_dict)
-    bucket = None
     transfer_list = []
     for filename in file_list:
-        bucket_name, key_name = os.path.relpath(filename, trawl_dir).split("/", 1)
+        s3_url = retry_transfer_file(trawl_dir, boto_dict, filename)
+        if s3_url:
+            transfer_list.append(s3_url)
+    return transfer_list
+
+
+def retry_transfer_file(trawl_dir, boto_dict, filename, controller=None):
+    """Transfer a single file to s3, retrying transient errors such as socket
+    errors and 503s with a backoff, up to UPLOAD_RETRIES times. This keeps a
+    busy or briefly unavailable gateway from failing the whole trawl.
+
+    Parameters
+    ----------
+    trawl_dir: string : The full path to the trawl directory
+    boto_dict: dict : parameter dict for boto connection.
+    filename: string : full path to the file to transfer.
+    controller: UploadController : Optional controller to limit concurrency and
+        bandwidth, and to report the latency and errors of each attempt to.
+
+    Returns
+    -------
+    s3_url: string : the s3 URL of the transferred file, None if the upload was incomplete.
+    """
+    try:
         file_size = os.path.getsize(filename)
-        if not bucket or bucket.name != bucket_name:
-            bucket = s3_create_bucket(s3_conn, bucket_name)
-        key = bucket.new_key(key_name)
-        res = key.set_contents_from_filename(filename)
-        if res == file_size:
-            os.unlink(filename)
-            transfer_list.append("/".join(["s3:/", bucket.name, key.name]))
+    except FileNotFoundError:
+        logger.warning("%s has gone since it was listed. Skipping upload.", filename)
+        return None
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        start_time = controller.acquire(file_size) if controller else None
+        try:
+            s3_url = transfer_file(trawl_dir, boto_dict, filename)
+        except Exception as err:
+            transient = is_transient_upload_error(err)
+            if controller:
+                controller.release(file_size, start_time, error=transient, failed=not transient)
+            if not transient or attempt == UPLOAD_RETRIES:
+                raise
+            logger.warning("Upload of %s failed on attempt %i (%s). Retrying.", filename, attempt, err)
+            time.sleep(2 ** attempt)
         else:
-            logger.error("%s not deleted. Only uploaded %i of %i bytes.", filename, res, file_size)
-    return transfer_list
+            if controller:
+                # a skipped or incomplete upload says nothing about the throughput
+                controller.release(file_size, start_time, failed=s3_url is None)
+            return s3_url
+
+
+def transfer_file(trawl_dir, boto_dict, filename):
+    """Transfer a single file to s3, using the connection for the current
+    upload worker. The file is deleted once the upload has been verified.
+    A file that has gone since it was listed is skipped. Uploads that s3
+    rejects outright, e.g. an invalid bucket name or access denied, are tagged
+    with the bucket name, so that the failed token can be set on the bucket
+    directory. Other failures are left for the next trawl to retry.
+
+    Parameters
+    ----------
+    trawl_dir: string : The full path to the trawl directory
+    boto_dict: dict : parameter dict for boto connection.
+    filename: string : full path to the file to transfer.
+
+    Returns
+    -------
+    s3_url: string : the s3 URL of the transferred file, None if the upload was incomplete.
+    """
+    bucket_name, key_name = os.path.relpath(filename, trawl_dir).split("/", 1)
+    try:
+        s3_conn = get_worker_s3_connection(boto_dict)
+        file_size = os.path.getsize(filename)
+        bucket = get_worker_bucket(s3_conn, bucket_name)
+        if file_size > MULTIPART_THRESHOLD:
+            res = multipart_upload(boto_dict, bucket, key_name, filename, file_size)
+        else:
+            key = bucket.new_key(key_name)
+            res = key.set_contents_from_filename(filename)
+    except FileNotFoundError:
+        # uploaded by an earlier trawl or cleaned up since it was listed
+        logger.warning("%s has gone since it was listed. Skipping upload.", filename)
+        return None
+    except (socket.error, boto.exception.S3ResponseError) as err:
+        # start the next upload in this worker with a fresh connection
+        reset_worker_s3_connection()
+        if isinstance(err, boto.exception.S3ResponseError) and not is_transient_upload_error(err):
+            err.bucket_name = bucket_name
+            err.filename = filename
+        raise
+    if res == file_size:
+        os.unlink(filename)
+        return "/".join(["s3:/", bucket_name, key_name])
+    logger.error("%s not deleted. Only uploaded %i of %i bytes.", filename, res, file_size)
+    return None
+
+
+def get_worker_s3_connection(boto_dict):
+    """Return the s3 connection for the current upload worker, connecting on
+    first use. The connection is reused by every upload that runs in the worker,
+    which saves a connect and authentication round trip per upload. Workers are
+    either processes in the upload pool or threads of the asyncio engine.
+
+    Parameters
+    ----------
+    boto_dict: dict : parameter dict for boto connection.
+
+    Returns
+    -------
+    s3_conn : S3Connection : the connection for this worker.
+    """
+    if getattr(_worker_state, 's3_conn', None) is None:
+        _worker_state.s3_conn = get_s3_connection(boto_dict)
+        _worker_state.buckets = {}
+    return _worker_state.s3_conn
+
+
+def get_worker_bucket(s3_conn, bucket_name):
+    """Return a bucket, creating it on first use in the current upload worker.
+
+    Parameters
+    ----------
+    s3_conn : S3Connection : the connection for this worker.
+    bucket_name: string : the name of the bucket.
+
+    Returns
+    -------
+    s3_bucket : boto.s3.bucket.Bucket : An S3 Bucket object
+    """
+    if bucket_name not in _worker_state.buckets:
+        _worker_state.buckets[bucket_name] = s3_create_bucket(s3_conn, bucket_name)
+    return _worker_state.buckets[bucket_name]
+
+
+def reset_worker_s3_connection():
+    """Drop the s3 connection and buckets for the current upload worker."""
+    if getattr(_worker_state, 's3_conn', None) is not None:
+        _worker_state.s3_conn.close()
+    _worker_state.s3_conn = None
+    _worker_state.buckets = {}
+
+
+def upload_worker_count():
+    """Number of upload worker processes, CPU_MULTIPLIER workers per CPU.
+
+    Returns
+    -------
+    workers: int : number of worker processes to upload with.
+    """
+    return CPU_MULTIPLIER * multiprocessing.cpu_count()
+
+
+def make_upload_pool(workers):
+    """Create a pool of upload worker processes.
+
+    Parameters
+    ----------
+    workers: int : number of worker processes. parallel_upload packs the files
+        into batches for upload_worker_count() workers, so pass that.
+
+    Returns
+    -------
+    upload_pool: ProcessPoolExecutor : a pool of upload workers.
+    """
+    return futures.ProcessPoolExecutor(max_workers=workers)
+
+
+def async_upload(trawl_dir, boto_dict, file_list):
+    """Upload files to s3 from this process, with up to UPLOAD_CONCURRENCY
+    uploads in flight. An alternative to the pool of upload processes for
+    I/O bound uploads of many small files.
+
+    boto has no asynchronous transport, so each upload runs on a thread of
+    a long lived pool of UPLOAD_CONCURRENCY threads, each thread keeping its
+    own connection, while asyncio collects the uploads. Within that limit,
+    an UploadController adapts the number of uploads in flight to the
+    observed PUT latency, throughput and errors, and caps the bandwidth at
+    MAX_UPLOAD_RATE.
+
+    Parameters
+    ----------
+    trawl_dir: string : The full path to the trawl directory
+    boto_dict: dict : parameter dict for boto connection.
+    file_list: list : a list of full path to files to transfer.
+
+    Returns
+    -------
+    procs: list : a list of completed tasks, one per file, each returning a
+        list with the transferred s3 URL.
+    """
+    return asyncio.run(_async_upload(trawl_dir, boto_dict, file_list))
+
+
+async def _async_upload(trawl_dir, boto_dict, file_list):
+    global _async_upload_executor, _upload_controller
+    # the pipeline can upload from more than one thread
+    with _async_upload_lock:
+        if _async_upload_executor is None:
+            _async_upload_executor = futures.ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY,
+                                                                thread_name_prefix='upload')
+            _upload_controller = UploadController(UPLOAD_CONCURRENCY, max_rate=MAX_UPLOAD_RATE)
+    loop = asyncio.get_running_loop()
+
+    async def upload(filename):
+        # the thread pool limits the uploads in flight to UPLOAD_CONCURRENCY
+        s3_url = await loop.run_in_executor(_async_upload_executor, retry_transfer_file,
+                                            trawl_dir, boto_dict, filename, _upload_controller)
+        return [s3_url] if s3_url else []
+
+    procs = [loop.create_task(upload(f)) for f in file_list]
+    if procs:
+        await asyncio.wait(procs)
+    return procs
+
+
+def multipart_upload(boto_dict, bucket, key_name, filename, file_size):
+    """Upload a large file to s3 as a multipart upload, with the parts uploaded
+    concurrently. Failed parts are retried individually, and the upload is
+    cancelled if a part fails MULTIPART_RETRIES times.
+
+    Parameters
+    ----------
+    boto_dict: dict : parameter dict for boto connection.
+    bucket: boto.s3.bucket.Bucket : The bucket to upload into.
+    key_name: string : The name of the key to create.
+    filename: string : Full path to the file to upload.
+    file_size: int : Size of the file in bytes.
+
+    Returns
+    -------
+    size: int : The size in bytes of the completed object as reported by s3,
+        used to verify the upload before deleting the file.
+    """
+    part_size = max(MULTIPART_CHUNK_SIZE, -(-file_size // MULTIPART_MAX_PARTS))
+    parts = [(part_num, offset, min(part_size, file_size - offset))
+             for part_num, offset in enumerate(range(0, file_size, part_size), 1)]
+    logger.debug("Uploading %s in %i parts.", filename, len(parts))
+    mp = bucket.initiate_multipart_upload(key_name)
+    try:
+        with futures.ThreadPoolExecutor(max_workers=MULTIPART_WORKERS) as executor:
+            procs = [executor.submit(upload_part, boto_dict, bucket.name, key_name, mp.id,
+                                     filename, part_num, offset, size)
+                     for part_num, offset, size in parts]
+            for p in procs:
+                p.result()
+        mp.complete_upload()
+    except Exception:
+        logger.error("Multipart upload of %s failed. Cancelling upload.", filename)
+        mp.cancel_upload()
+        raise
+    # verify the completed object
+    key = bucket.get_key(key_name)
+    if key is None:
+        return 0
+    return key.size
 
 
-def parallel_upload(trawl_dir, boto_dict, file_list):
+def upload_part(boto_dict, bucket_name, key_name, upload_id, filename, part_num, offset, size):
+    """Upload a single part of a multipart upload, retrying on failure.
+    Each part uses its own connection, as boto connections are not thread safe.
+
+    Parameters
+    ----------
+    boto_dict: dict : parameter dict for boto connection.
+    bucket_name: string : The name of the bucket.
+    key_name: string : The name of the key being uploaded.
+    upload_id: string : The id of the multipart upload.
+    filename: string : Full path to the file being uploaded.
+    part_num: int : The part number, starting at 1.
+    offset: int : Offset in bytes of the part in the file.
+    size: int : Size in bytes of the part.
     """
+    s3_conn = boto.connect_s3(**boto_dict)
+    try:
+        bucket = s3_conn.get_bucket(bucket_name, validate=False)
+        mp = boto.s3.multipart.MultiPartUpload(bucket)
+        mp.key_name = key_name
+        mp.id = upload_id
+        for attempt in range(1, MULTIPART_RETRIES + 1):
+            try:
+                with open(filename, 'rb') as f:
+                    f.seek(offset)
+                    mp.upload_part_from_file(f, part_num, size=size)
+                break
+            except (socket.error, boto.exception.S3ResponseError) as e:
+                if attempt == MULTIPART_RETRIES:
+                    raise
+                logger.warning("Part %i of %s failed on attempt %i (%s). Retrying.", part_num, filename, attempt, e)
+                time.sleep(2 ** attempt)
+    finally:
+        s3_conn.close()
+
+
+def parallel_upload(trawl_dir, boto_dict, file_list, upload_pool=None):
+    """Upload files to s3 using the configured UPLOAD_ENGINE.
+
+    With the 'process' engine, a pool of worker processes is used. The files
+    are packed into batches of roughly equal size, largest files first, and
+    workers take the next batch from the shared executor queue as they
+    finish, so that a few large files don't hold up the whole upload.
+    With the 'asyncio' engine, files are uploaded from this process by
+    async_upload.
+
+    Parameters
+    ----------
+    trawl_dir: string : The full path to the trawl directory
+    boto_dict: dict : parameter dict for boto connection.
+    file_list: list : a list of full path to files to transfer.
+    upload_pool: ProcessPoolExecutor : Optional long lived pool of upload workers. If
+        not given, a pool is created for this upload only.
+
+    Returns
+    -------
+    procs: list : a list of futures, each returning a list of transferred s3 URLs.
     """
-    max_workers = CPU_MULTIPLIER * multiprocessing.cpu_count()
-    if len(file_list) < max_workers:
-        workers = len(file_list)
+    file_sizes = {f: os.path.getsize(f) for f in file_list}
+    start_time = time.time()
+    if UPLOAD_ENGINE == 'asyncio':
+        workers = min(len(file_list), UPLOAD_CONCURRENCY)
+        logger.debug("Processing %i files with up to %i concurrent uploads", len(file_list), workers)
+        procs = async_upload(trawl_dir, boto_dict, file_list)
     else:
-        workers = max_workers
-    logger.debug("Using %i workers", workers)
-    files = [file_list[i::workers] for i in range(workers)]
-    logger.debug("Processing %i files", len(file_list))
-    procs = []
-    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
-        for f in files:
-            procs.append(executor.submit(transfer_files, trawl_dir, boto_dict, f))
-        executor.shutdown(wait=True)
+        workers = min(len(file_list), upload_worker_count())
+        logger.debug("Using %i workers", workers)
+        batches = make_upload_batches(file_sizes, workers * BATCHES_PER_WORKER)
+        logger.debug("Processing %i files in %i batches", len(file_list), len(batches))
+        procs = []
+        if upload_pool:
+            for b in batches:
+                procs.append(upload_pool.submit(transfer_files, trawl_dir, boto_dict, b))
+            futures.wait(procs)
+        else:
+            with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for b in batches:
+                    procs.append(executor.submit(transfer_files, trawl_dir, boto_dict, b))
+                executor.shutdown(wait=True)
+    makespan = time.time() - start_time
+    upload_size = sum(file_sizes.values())
+    logger.info("Uploaded %.2f MB in %i files with %i workers. Makespan %.2f s (%.2f MB/s).",
+                upload_size / 1e6, len(file_list), workers, makespan, upload_size / 1e6 / max(makespan, 1e-6))
     return procs
 
 
+def make_upload_batches(file_sizes, num_batches):
+    """Pack files into batches of roughly equal size. Files are taken
+    largest first, so that the large files are started early and the small
+    files at the end of the queue even out the load across workers.
+
+    Parameters
+    ----------
+    file_sizes: dict : file name to file size in bytes.
+    num_batches: int : the approximate number of batches to create.
+
+    Returns
+    -------
+    batches: list : a list of file lists, the batches with the largest files first.
+    """
+    target_size = sum(file_sizes.values()) / max(num_batches, 1)
+    batches = []
+    batch = []
+    batch_size = 0
+    for f in sorted(file_sizes, key=file_sizes.get, reverse=True):
+        batch.append(f)
+        batch_size += file_sizes[f]
+        if batch_size >= target_size:
+            batches.append(sorted(batch))
+            batch = []
+            batch_size = 0
+    if batch:
+        batches.append(sorted(batch))
+    return batches
+
+
 def s3_create_anon_access_policy(bucket_name):
     """Create a bucket policy for anonymous read access and anonymous bucket listing.
     Returns
@@ -452,11 +1239,47 @@ if __name__ == "__main__":
                       help="S3 gateway port [default = %default]")
     parser.add_option("--solr-url", default="http://kat-archive.kat.ac.za:8983/solr/kat_core",
                       help="Solr end point for metadata extraction [default = %default]")
+    parser.add_option("--multipart-threshold", type="float", default=MULTIPART_THRESHOLD / 1e6,
+                      help="Upload files larger than this (in MB) as concurrent multipart uploads "
+                           "[default = %default]")
+    parser.add_option("--upload-engine", type="choice", choices=["process", "asyncio"], default=UPLOAD_ENGINE,
+                      help="Upload with a pool of processes or with asyncio from a single process "
+                           "[default = %default]")
+    parser.add_option("--upload-concurrency", type="int", default=UPLOAD_CONCURRENCY,
+                      help="Maximum number of uploads in flight for the asyncio upload engine. "
+                           "Uploads adapt to the gateway below this limit [default = %default]")
+    parser.add_option("--max-upload-rate", type="float",
+                      help="Cap the upload rate of the asyncio upload engine (in MB/s) [default = no cap]")
+    parser.add_option("--ingest-concurrency", type="int", default=INGEST_CONCURRENCY,
+                      help="Maximum number of capture blocks to ingest at the same time [default = %default]")
+    parser.add_option("--watch", action="store_true", default=False,
+                      help="Use inotify to react to new files instead of polling the trawl directory. "
+                           "A full trawl still runs every %i seconds." % WATCH_RESCAN_TIME)
+    parser.add_option("--pipeline", action="store_true", default=False,
+                      help="Overlap scanning, capture block ingest and uploads in a pipeline of stages.")
+    parser.add_option("--metadata-spool",
+                      help="Spool metadata writes to this sqlite file while solr is unavailable, and keep "
+                           "uploading. Spooled writes are replayed in the background. Products are deleted "
+                           "once their metadata is spooled, so the file must be on persistent local storage, "
+                           "not a tmpfs or cache directory. Capture blocks are only ingested while solr is "
+                           "available [default = no spool]")
 
     (options, args) = parser.parse_args()
+    if options.watch and options.pipeline:
+        parser.error("--watch and --pipeline can't be used together.")
     if len(args) < 1 or not os.path.isdir(args[0]):
         print(__doc__)
         sys.exit()
 
+    MULTIPART_THRESHOLD = options.multipart_threshold * 1e6
+    UPLOAD_ENGINE = options.upload_engine
+    UPLOAD_CONCURRENCY = options.upload_concurrency
+    INGEST_CONCURRENCY = options.ingest_concurrency
+    if options.max_upload_rate:
+        MAX_UPLOAD_RATE = options.max_upload_rate * 1e6
+    if options.metadata_spool:
+        metadata_spool = MetaDataSpool(options.metadata_spool)
+        SpoolReplayer(metadata_spool, interval=SLEEP_TIME).start()
     boto_dict = make_boto_dict(options)
-    main(trawl_dir=args[0], boto_dict=boto_dict, solr_url=options.solr_url)
+    main(trawl_dir=args[0], boto_dict=boto_dict, solr_url=options.solr_url, watch=options.watch,
+         pipeline=options.pipeline)
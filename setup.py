@@ -9,7 +9,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         "boto", "katdal", "katpoint", "katsdpservices",
-        "katsdptelstate", "numpy", "pysolr"],
+        "katsdptelstate", "numpy", "pysolr", "requests"],
     url='http://ska.ac.za/',
     scripts=[
         "scripts/tel_prod_met_extractor.py",